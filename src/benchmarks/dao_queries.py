@@ -0,0 +1,213 @@
+"""
+Latency and documents examined of the UserDAO query paths on seeded databases of several sizes.
+
+    python3 -m benchmarks.dao_queries --scales 10000 100000 1000000
+    python3 -m benchmarks.dao_queries --save-baseline   # first run and after an intended change
+
+Every scale uses its own database <mongodb.name>_bench_<scale> seeded by utils.seed.
+The run is compared to benchmarks/baseline.json and exits with code 1 on a regression,
+and with code 2 before running when a scale has no baseline (unless --save-baseline).
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+from copy import deepcopy
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import numpy as np
+
+from dao import setup_dao
+from managers import setup_managers
+from models.app import App
+from settings import get_config
+from utils.seed import DEFAULT_START_USER_ID, drop_seeded_users, seed_users
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_SCALES = [10_000, 100_000, 1_000_000]
+META_COLLECTION = "bench_meta"
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class Case:
+    name: str
+    run: Callable[[App, int], Awaitable]  # (app, user_id)
+    # queries over all users take seconds at 1M, a few runs are enough for them
+    repeats: int = 50
+
+
+CASES = [
+    Case("get_users_top", lambda app, uid: app.Dao.user.get_users_top(uid)),
+    *[Case(f"get_talk_time[{interval}]", lambda app, uid, interval=interval: app.Dao.user.get_talk_time(uid, interval))
+      for interval in ("day", "week", "month", "total", "dialog")],
+    Case("get_usage_by_weekday", lambda app, uid: app.Dao.user.get_usage_by_weekday(uid)),
+    *[Case(f"get_general_funnel_voices[{interval}]",
+           lambda app, uid, interval=interval: app.Dao.user.get_general_funnel_voices(interval),
+           repeats=5)
+      # the funnel doesn't filter by interval
+      for interval in ("total",)],
+    *[Case(f"get_general_bottle_days[{interval}]",
+           lambda app, uid, interval=interval: app.Dao.user.get_general_bottle_days(interval),
+           repeats=5)
+      for interval in ("week", "total")],
+]
+
+
+async def setup_scale(config: dict, scale: int, seed: int, reuse: bool) -> App:
+    """connects the app to the database of the scale and seeds it if needed"""
+    app = App()
+    app["config"] = deepcopy(config)
+    app["config"]["mongodb"]["name"] = f'{config["mongodb"]["name"]}_bench_{scale}'
+    # measure the database, not the user cache
+    app["config"].setdefault("cache", {})["user"] = {"enabled": False}
+    await setup_managers(app)
+    await setup_dao(app)
+
+    meta_collection = app.Managers.db_manager.db[META_COLLECTION]
+    meta = await meta_collection.find_one({"_id": "seed"})
+    expected = {"users": scale, "seed": seed}
+    # interval queries depend on today, data seeded on another day examines other documents
+    fresh = meta is not None and meta.get("seeded_on") == datetime.date.today().isoformat()
+    if meta is None or {k: meta.get(k) for k in expected} != expected or not (fresh or reuse):
+        logger.info(f"Seeding {scale} users into {app['config']['mongodb']['name']}")
+        await drop_seeded_users(app)
+        await seed_users(app, scale, seed=seed)
+        await meta_collection.replace_one(
+            {"_id": "seed"}, {**expected, "seeded_on": datetime.date.today().isoformat()}, upsert=True
+        )
+    await app.Managers.leaderboard.rebuild(app.Dao.talk_time)
+    return app
+
+
+async def docs_examined(app: App, case: Case, user_ids: list[int]) -> dict:
+    """runs the case once per sample user with the profiler on and sums the profiled operations"""
+    db = app.Managers.db_manager.db
+    await db.command({"profile": 0})
+    await db["system.profile"].drop()
+    await db.command({"profile": 2})
+    try:
+        for user_id in user_ids:
+            await case.run(app, user_id)
+    finally:
+        await db.command({"profile": 0})
+
+    totals = {"docs_examined": 0, "keys_examined": 0, "operations": 0, "collscans": 0}
+    async for op in db["system.profile"].find({"ns": {"$ne": f"{db.name}.system.profile"}}):
+        totals["docs_examined"] += op.get("docsExamined", 0)
+        totals["keys_examined"] += op.get("keysExamined", 0)
+        totals["operations"] += 1
+        totals["collscans"] += "COLLSCAN" in op.get("planSummary", "")
+    # per call, comparable between runs with another number of repeats
+    return {key: round(value / len(user_ids), 1) for key, value in totals.items()}
+
+
+async def run_case(app: App, case: Case, user_ids: list[int]) -> dict:
+    await case.run(app, user_ids[0])  # warm up
+    latencies = []
+    for user_id in user_ids:
+        started = time.perf_counter()
+        await case.run(app, user_id)
+        latencies.append((time.perf_counter() - started) * 1000)
+    result = {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))}
+    result["max"] = round(max(latencies), 2)
+    result.update(await docs_examined(app, case, user_ids[:min(len(user_ids), 5)]))
+    return result
+
+
+async def run_scale(config: dict, scale: int, seed: int, reuse: bool) -> dict:
+    app = await setup_scale(config, scale, seed, reuse)
+    try:
+        rng = np.random.default_rng(seed)
+        results = {}
+        for case in CASES:
+            user_ids = (DEFAULT_START_USER_ID + rng.integers(0, scale, case.repeats)).tolist()
+            results[case.name] = await run_case(app, case, user_ids)
+            logger.info(f"{scale} {case.name}: {results[case.name]}")
+        return results
+    finally:
+        await app.Managers.db_manager.disconnect()
+
+
+def compare(results: dict, baseline: dict, latency_tolerance: float, docs_tolerance: float,
+            min_delta_ms: float) -> list[str]:
+    """returns regressions: p95 latency or documents examined per call above the baseline"""
+    regressions = []
+    for scale, cases in results.items():
+        for name, result in cases.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                continue
+            if (result["p95"] > base["p95"] * (1 + latency_tolerance)
+                    and result["p95"] - base["p95"] > min_delta_ms):
+                regressions.append(f"{scale} {name}: p95 {base['p95']} -> {result['p95']} ms")
+            for key in ("docs_examined", "keys_examined"):
+                if result[key] > base[key] * (1 + docs_tolerance) + 1:
+                    regressions.append(f"{scale} {name}: {key} {base[key]} -> {result[key]}")
+            if result["collscans"] > base["collscans"]:
+                regressions.append(f"{scale} {name}: collscans {base['collscans']} -> {result['collscans']}")
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="UserDAO query benchmarks")
+    parser.add_argument("--config", dest="config", type=str, default=os.environ.get("APP_CONFIG", "config.yaml"))
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES, help="numbers of seeded users")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reuse-data", action="store_true", help="don't reseed data seeded on another day")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", "--write-baseline", action="store_true",
+                        help="store the results as the new baseline, required while a scale has none")
+    parser.add_argument("--output", type=str, default=None, help="also write the results to this json file")
+    parser.add_argument("--latency-tolerance", type=float, default=0.5, help="allowed relative p95 growth")
+    parser.add_argument("--min-delta-ms", type=float, default=5, help="ignore smaller p95 growth (timer noise)")
+    parser.add_argument("--docs-tolerance", type=float, default=0.1,
+                        help="allowed relative growth of documents and keys examined")
+    return parser
+
+
+async def main(argv) -> int:
+    args = get_parser().parse_args(argv)
+    config = get_config(argv)
+    logging.basicConfig(level=logging.getLevelName(config["logging_level"]))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    # json keys are strings
+    missing = [str(scale) for scale in args.scales if str(scale) not in baseline]
+    if missing and not args.save_baseline:
+        # without a baseline the check could never fail
+        logger.error(f"No baseline for scales {missing} in {args.baseline}, run with --save-baseline first")
+        return 2
+
+    results = {str(scale): await run_scale(config, scale, args.seed, args.reuse_data) for scale in args.scales}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        logger.info(f"Baseline saved to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.latency_tolerance, args.docs_tolerance, args.min_delta_ms)
+    for regression in regressions:
+        logger.error(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(sys.argv[1:])))
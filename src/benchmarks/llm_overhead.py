@@ -0,0 +1,136 @@
+"""
+Per-turn overhead of the voice_chat LLM path without calling OpenAI:
+building the chat model, prompt, parser and chain on every call (as before the model registry)
+against the precompiled chains of utils.gpt, and the HTTP connections opened for the same turns
+sent to a local OpenAI compatible stub.
+
+    python3 -m benchmarks.llm_overhead --turns 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+import numpy as np
+from aiohttp import web
+from langchain.output_parsers import PydanticOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_openai import ChatOpenAI
+
+from utils.gpt import HINTS_PROMPT, VOICE_CHAT_PROMPT, VOICE_CHAT_SYSTEM, ConversationSuggests
+
+PERCENTILES = (50, 95, 99)
+COMPLETION = {
+    "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "gpt-3.5-turbo",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "Nice! What did you eat?"},
+                 "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+HISTORY = [("human", "I had a long day at work."), ("ai", "Oh, what do you do?")] * 5
+VARIABLES = {"history": HISTORY, "input": "I am a developer, I write code.", "current_time": "12:00",
+             "bot_role": "english tutor"}
+
+
+def per_call_chain(base_url: str | None = None, is_hints: bool = False):
+    """what voice_chat built on every turn before the registry"""
+    model = ChatOpenAI(temperature=1, api_key="bench", base_url=base_url)
+    system_text = VOICE_CHAT_SYSTEM.format(current_time="12:00", bot_role="english tutor")
+    raw_prompt = [("system", system_text), MessagesPlaceholder(variable_name="history")]
+    if is_hints:
+        raw_prompt.append(("human", VARIABLES["input"] + "\nAnswer in this format: {format_instructions}"))
+        parser = PydanticOutputParser(pydantic_object=ConversationSuggests)
+        prompt = ChatPromptTemplate.from_messages(raw_prompt)
+        prompt = prompt.partial(format_instructions=parser.get_format_instructions())
+        return prompt | model | parser
+    raw_prompt.append(("human", VARIABLES["input"]))
+    return ChatPromptTemplate.from_messages(raw_prompt) | model
+
+
+def percentiles(samples_ms: list[float]) -> dict:
+    return {f"p{p}": round(float(np.percentile(samples_ms, p)), 3) for p in PERCENTILES}
+
+
+def construction_overhead(turns: int) -> dict:
+    """time to get a prompt value ready to send, per turn"""
+    results = {}
+    for is_hints in (False, True):
+        name = "hints" if is_hints else "chat"
+        per_call, precompiled = [], []
+        prompt = HINTS_PROMPT if is_hints else VOICE_CHAT_PROMPT
+        for _ in range(turns):
+            started = time.perf_counter()
+            chain = per_call_chain(is_hints=is_hints)
+            chain.first.invoke({"history": HISTORY})
+            per_call.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            prompt.invoke(VARIABLES)
+            precompiled.append((time.perf_counter() - started) * 1000)
+        results[name] = {"per_call_ms": percentiles(per_call), "precompiled_ms": percentiles(precompiled)}
+    return results
+
+
+async def connection_reuse(turns: int) -> dict:
+    """connections opened by the stub for sequential turns, new model per turn vs one shared model"""
+    peers = set()
+
+    async def completions(request: web.Request):
+        peers.add(request.transport.get_extra_info("peername"))
+        await request.read()
+        return web.json_response(COMPLETION)
+
+    stub = web.Application()
+    stub.router.add_post("/v1/chat/completions", completions)
+    runner = web.AppRunner(stub)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/v1"
+
+    results = {}
+    try:
+        started = time.perf_counter()
+        for _ in range(turns):
+            await per_call_chain(base_url).ainvoke({"history": HISTORY})
+        results["per_call"] = {"connections": len(peers), "total_s": round(time.perf_counter() - started, 3)}
+
+        peers.clear()
+        async with httpx.AsyncClient() as http_client:
+            chain = VOICE_CHAT_PROMPT | ChatOpenAI(temperature=1, api_key="bench", base_url=base_url,
+                                                   http_async_client=http_client)
+            started = time.perf_counter()
+            for _ in range(turns):
+                await chain.ainvoke(VARIABLES)
+            results["shared"] = {"connections": len(peers), "total_s": round(time.perf_counter() - started, 3)}
+    finally:
+        await runner.cleanup()
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="LLM call path overhead")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--output", type=str, default=None, help="also write the results to this json file")
+    return parser
+
+
+async def main(argv) -> int:
+    args = get_parser().parse_args(argv)
+    results = {
+        "turns": args.turns,
+        "construction": construction_overhead(args.turns),
+        "connections": await connection_reuse(args.turns),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("APP_CONFIG", "config.yaml")
+    sys.exit(asyncio.run(main(sys.argv[1:])))
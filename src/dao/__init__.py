@@ -1,5 +1,11 @@
-from dataclasses import dataclass 
+from dataclasses import dataclass
 from dao.base import BaseDAO
+from dao.media_dao import MediaDAO
+from dao.message_archive_dao import MessageArchiveDAO
+from dao.message_dao import MessageDAO
+from dao.stats_snapshot_dao import StatsSnapshotDAO
+from dao.talk_time_dao import TalkTimeRollupDAO
+from dao.translation_dao import TranslationDAO
 from dao.user_dao import UserDAO
 
 
@@ -7,7 +13,13 @@ from dao.user_dao import UserDAO
 @dataclass
 class DAO:
     user: UserDAO
-    
+    message: MessageDAO
+    message_archive: MessageArchiveDAO
+    talk_time: TalkTimeRollupDAO
+    stats: StatsSnapshotDAO
+    media: MediaDAO
+    translation: TranslationDAO
+
     @property
     def dao_list(self) -> list[BaseDAO]:
         return list(filter(lambda dao: isinstance(dao, BaseDAO), self.__dict__.values()))
@@ -16,6 +28,12 @@ class DAO:
 async def setup_dao(app):
     app.Dao = DAO(
         user=UserDAO(app),
+        message=MessageDAO(app),
+        message_archive=MessageArchiveDAO(app),
+        talk_time=TalkTimeRollupDAO(app),
+        stats=StatsSnapshotDAO(app),
+        media=MediaDAO(app),
+        translation=TranslationDAO(app),
     )
 
     for dao in app.Dao.dao_list:
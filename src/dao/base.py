@@ -1,3 +1,6 @@
+from dao.indexes import IndexSpec, reconcile_indexes
+
+
 class BaseDAO:
     def __init__(self, app) -> None:
         pass
@@ -7,13 +10,26 @@ class BaseDAO:
 
 
 class BaseDBDAO(BaseDAO):
+    COLLECTION_NAME: str = None
+    # indexes of COLLECTION_NAME, created on startup (mongodb.ensure_indexes) or by `manage.py indexes`
+    INDEXES: list[IndexSpec] = []
+
     def __init__(self, app) -> None:
         super().__init__(app)
         self.db_manager = app.Managers.db_manager
         self.db = self.db_manager.db
+        self.ensure_indexes = app["config"]["mongodb"].get("ensure_indexes", True)
 
     async def async_init(self) -> None:
-        return
+        if self.ensure_indexes and self.INDEXES:
+            report = await reconcile_indexes(self.db[self.COLLECTION_NAME], self.INDEXES, usage=False)
+            report.log()
+
+    def explain_queries(self) -> dict[str, dict]:
+        """
+        typical queries of the DAO as find/aggregate command bodies, checked by `manage.py indexes --explain`
+        """
+        return {}
 
 
 class BaseSessionDAO(BaseDAO):
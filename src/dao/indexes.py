@@ -0,0 +1,186 @@
+import logging
+from dataclasses import dataclass, field
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class IndexSpec:
+    """
+    Declaration of one index of a DAO collection, see BaseDBDAO.INDEXES
+    keys: [(field, 1 | -1)]
+    partial: partialFilterExpression, the index only covers matching documents
+    ttl: expireAfterSeconds, mongo deletes documents this long after the date in the (single) key field
+    """
+    keys: list[tuple[str, int]]
+    unique: bool = False
+    partial: dict | None = None
+    ttl: int | None = None
+    name: str | None = None
+
+    def __post_init__(self):
+        self.keys = [tuple(key) for key in self.keys]
+        if self.name is None:
+            # same naming as mongo uses by default
+            self.name = "_".join(f"{key}_{direction}" for key, direction in self.keys)
+
+    @property
+    def options(self) -> dict:
+        options = {}
+        if self.unique:
+            options["unique"] = True
+        if self.partial is not None:
+            options["partialFilterExpression"] = self.partial
+        if self.ttl is not None:
+            options["expireAfterSeconds"] = self.ttl
+        return options
+
+    def to_model(self) -> IndexModel:
+        return IndexModel(self.keys, name=self.name, **self.options)
+
+    def matches(self, info: dict) -> bool:
+        """compares options with an entry of collection.index_information()"""
+        return (
+            bool(info.get("unique")) == self.unique
+            and info.get("partialFilterExpression") == self.partial
+            and info.get("expireAfterSeconds") == self.ttl
+        )
+
+
+@dataclass
+class IndexReport:
+    collection: str
+    created: list[str] = field(default_factory=list)
+    missing: list[str] = field(default_factory=list)
+    ok: list[str] = field(default_factory=list)
+    # declared, but an index with the same keys exists with other options
+    conflicts: list[str] = field(default_factory=list)
+    # exist in the collection, but not declared by the DAO
+    extra: list[str] = field(default_factory=list)
+    # no operations since the last mongod restart, from $indexStats
+    unused: list[str] = field(default_factory=list)
+    errors: list[str] = field(default_factory=list)
+
+    def log(self) -> None:
+        for name in self.created:
+            logger.info(f"{self.collection}: created index {name}")
+        for name in self.missing:
+            logger.warning(f"{self.collection}: missing index {name}")
+        for problem in self.conflicts + self.errors:
+            logger.warning(f"{self.collection}: index {problem}")
+
+
+async def reconcile_indexes(collection, specs: list[IndexSpec], create: bool = True,
+                            fix_conflicts: bool = False, drop_extra: bool = False,
+                            usage: bool = True) -> IndexReport:
+    """
+    Brings the collection indexes to the declared ones.
+    create: create missing indexes, otherwise only report them
+    fix_conflicts: drop and recreate indexes whose options differ from the declaration
+    drop_extra: drop indexes that are not declared
+    usage: also report unused indexes
+    """
+    report = IndexReport(collection.name)
+    existing = await collection.index_information()
+    by_keys = {tuple(tuple(key) for key in info["key"]): name for name, info in existing.items()}
+
+    declared_names = set()
+    for spec in specs:
+        existing_name = by_keys.get(tuple(spec.keys))
+        if existing_name is not None:
+            declared_names.add(existing_name)
+            if spec.matches(existing[existing_name]):
+                report.ok.append(existing_name)
+                continue
+            if not fix_conflicts:
+                report.conflicts.append(f"{existing_name}: has {_describe(existing[existing_name])}, "
+                                        f"declared {spec.options or 'no options'}")
+                continue
+            await collection.drop_index(existing_name)
+        if not create:
+            report.missing.append(spec.name)
+            continue
+        try:
+            await collection.create_indexes([spec.to_model()])
+        except OperationFailure as e:
+            # e.g. duplicates for a unique index or a name taken by another index
+            report.errors.append(f"{spec.name}: {e.details.get('errmsg', e) if e.details else e}")
+            continue
+        declared_names.add(spec.name)
+        report.created.append(spec.name)
+
+    for name in existing:
+        if name == "_id_" or name in declared_names:
+            continue
+        if drop_extra:
+            await collection.drop_index(name)
+        report.extra.append(name)
+
+    if usage:
+        report.unused = await find_unused_indexes(collection)
+    return report
+
+
+async def find_unused_indexes(collection) -> list[str]:
+    """indexes without operations since the last mongod restart ($indexStats, needs clusterMonitor on atlas)"""
+    try:
+        stats = [s async for s in collection.aggregate([{"$indexStats": {}}])]
+    except OperationFailure as e:
+        logger.debug(f"$indexStats is not available for {collection.name}: {e}")
+        return []
+    return sorted(s["name"] for s in stats if s["name"] != "_id_" and s["accesses"]["ops"] == 0)
+
+
+def _describe(info: dict) -> dict | str:
+    return {key: info[key] for key in ("unique", "partialFilterExpression", "expireAfterSeconds") if key in info} \
+        or "no options"
+
+
+async def explain(db, command: dict) -> dict:
+    """
+    command: body of a find/aggregate/count command, e.g. {"aggregate": "messages", "pipeline": [...], "cursor": {}}
+    returns {"stages": [...], "indexes": [...], "collscan": bool} of the winning plan
+    """
+    result = await db.command({"explain": command, "verbosity": "queryPlanner"})
+    stages, indexes = [], []
+    _walk_plan(result, stages, indexes)
+    return {"stages": stages, "indexes": sorted(set(indexes)), "collscan": "COLLSCAN" in stages}
+
+
+def _walk_plan(node, stages: list, indexes: list) -> None:
+    if isinstance(node, dict):
+        if "stage" in node:
+            stages.append(node["stage"])
+        if "indexName" in node:
+            indexes.append(node["indexName"])
+        for key, value in node.items():
+            if key != "rejectedPlans":
+                _walk_plan(value, stages, indexes)
+    elif isinstance(node, list):
+        for value in node:
+            _walk_plan(value, stages, indexes)
+
+
+async def reconcile_all(app, **kwargs) -> list[IndexReport]:
+    reports = []
+    for dao in app.Dao.dao_list:
+        if not getattr(dao, "INDEXES", None):
+            continue
+        reports.append(await reconcile_indexes(dao.db[dao.COLLECTION_NAME], dao.INDEXES, **kwargs))
+    return reports
+
+
+async def explain_all(app) -> dict[str, dict]:
+    """explains the sample queries of every DAO, {"<dao>.<query>": explain(...)}"""
+    result = {}
+    for dao in app.Dao.dao_list:
+        for name, command in getattr(dao, "explain_queries", lambda: {})().items():
+            key = f"{type(dao).__name__}.{name}"
+            try:
+                result[key] = await explain(dao.db, command)
+            except OperationFailure as e:
+                result[key] = {"error": str(e)}
+    return result
@@ -0,0 +1,37 @@
+import datetime
+
+from dao.base import BaseDBDAO
+from dao.indexes import IndexSpec
+from models.update_context import count_db_read
+
+
+class MediaDAO(BaseDBDAO):
+    """
+    Telegram file_ids of uploaded local media: {sha256, media_type, path, size, file_id, uploaded_at}
+    Keyed by the content hash, so an edited asset is uploaded again. Used by utils.media.send_media
+    """
+    COLLECTION_NAME = "media_file_ids"
+    INDEXES = [
+        IndexSpec([("sha256", 1), ("media_type", 1)], unique=True),
+    ]
+
+    def __init__(self, app) -> None:
+        super().__init__(app)
+
+    async def get_file_id(self, sha256: str, media_type: str) -> str | None:
+        count_db_read()
+        record = await self.db[self.COLLECTION_NAME].find_one(
+            {"sha256": sha256, "media_type": media_type}, {"_id": 0, "file_id": 1}
+        )
+        return record["file_id"] if record else None
+
+    async def save(self, sha256: str, media_type: str, path: str, size: int, file_id: str) -> None:
+        await self.db[self.COLLECTION_NAME].update_one(
+            {"sha256": sha256, "media_type": media_type},
+            {"$set": {"path": path, "size": size, "file_id": file_id, "uploaded_at": datetime.datetime.now()}},
+            upsert=True
+        )
+
+    async def forget(self, sha256: str, media_type: str, file_id: str) -> None:
+        """deletes the rejected file_id only, a newer one saved by another process is kept"""
+        await self.db[self.COLLECTION_NAME].delete_one({"sha256": sha256, "media_type": media_type, "file_id": file_id})
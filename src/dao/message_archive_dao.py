@@ -0,0 +1,144 @@
+import datetime
+import zlib
+from collections import defaultdict
+from typing import AsyncIterator
+
+import bson
+
+from dao.base import BaseDBDAO
+from dao.indexes import IndexSpec
+from dao.message_dao import MessageDAO
+from models.update_context import count_db_read
+
+try:
+    import zstandard
+except ImportError:  # optional, buckets are written with zlib then
+    zstandard = None
+
+ROLES = ("user", "assistant")
+
+
+def compress(data: bytes, codec: str, level: int | None = None) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    return zlib.compress(data, level or 6)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard package is required to read zstd archive buckets")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class MessageArchiveDAO(BaseDBDAO):
+    """
+    Cold history: messages of finished dialogs older than archive.max_age_days, one bucket per user per month:
+    {user_id, month, count, first_index, last_index, first_created_at, last_created_at,
+     talk_time: {user, assistant}, messages: {user, assistant}, tokens,
+     days: [{date, talk_time: {...}, messages: {...}, tokens}], codec, raw_size, stored_size, payload, archived_at}
+    payload is the compressed BSON of {"messages": [...]}, analytics only read the header counters.
+    Filled by UserDAO.archive_old_messages
+    """
+    COLLECTION_NAME = "message_archive"
+    INDEXES = [
+        IndexSpec([("user_id", 1), ("month", 1)], unique=True),
+        # analytics include buckets newer than the interval start
+        IndexSpec([("first_created_at", 1)]),
+    ]
+
+    def __init__(self, app) -> None:
+        super().__init__(app)
+        archive_config = app["config"].get("archive", {})
+        codec = archive_config.get("codec", "zstd")
+        self.codec = "zstd" if codec == "zstd" and zstandard is not None else "zlib"
+        self.level = archive_config.get("level")
+
+    async def archive(self, user_id: int, messages: list[dict]) -> None:
+        """
+        writes the messages into the month buckets of the user, merging with the existing ones.
+        The caller deletes them from the messages collection afterwards
+        """
+        by_month = defaultdict(list)
+        for msg in messages:
+            msg = {key: value for key, value in msg.items() if key != "_id"}
+            by_month[datetime.datetime(msg["created_at"].year, msg["created_at"].month, 1)].append(msg)
+
+        for month, month_messages in by_month.items():
+            existing = await self.db[self.COLLECTION_NAME].find_one({"user_id": user_id, "month": month})
+            if existing is not None:
+                # a previous run may have been interrupted before deleting the hot copies
+                indexes = {msg["index"] for msg in month_messages}
+                month_messages += [msg for msg in self.decode(existing) if msg["index"] not in indexes]
+            await self.db[self.COLLECTION_NAME].replace_one(
+                {"user_id": user_id, "month": month}, self.build_bucket(user_id, month, month_messages), upsert=True
+            )
+
+    def build_bucket(self, user_id: int, month: datetime.datetime, messages: list[dict]) -> dict:
+        messages = sorted(messages, key=lambda msg: msg["index"])
+        days = {}
+        for msg in messages:
+            if msg.get("role") not in ROLES:
+                continue
+            date = datetime.datetime.combine(msg["created_at"].date(), datetime.time.min)
+            day = days.setdefault(date, {"date": date, "talk_time": dict.fromkeys(ROLES, 0),
+                                         "messages": dict.fromkeys(ROLES, 0), "tokens": 0})
+            day["talk_time"][msg["role"]] += msg.get("voice_duration") or 0
+            day["messages"][msg["role"]] += 1
+            day["tokens"] += msg.get("tokens") or 0
+
+        payload = bson.encode({"messages": messages})
+        compressed = compress(payload, self.codec, self.level)
+        return {
+            "user_id": user_id,
+            "month": month,
+            "count": len(messages),
+            "first_index": messages[0]["index"],
+            "last_index": messages[-1]["index"],
+            "first_created_at": messages[0]["created_at"],
+            "last_created_at": messages[-1]["created_at"],
+            "talk_time": {role: sum(day["talk_time"][role] for day in days.values()) for role in ROLES},
+            "messages": {role: sum(day["messages"][role] for day in days.values()) for role in ROLES},
+            "tokens": sum(day["tokens"] for day in days.values()),
+            "days": list(days.values()),
+            "codec": self.codec,
+            "raw_size": len(payload),
+            "stored_size": len(compressed),
+            "payload": bson.Binary(compressed),
+            "archived_at": datetime.datetime.now(),
+        }
+
+    @staticmethod
+    def decode(bucket: dict) -> list[dict]:
+        return bson.decode(decompress(bucket["payload"], bucket["codec"]))["messages"]
+
+    async def iter_history(self, user_id: int) -> AsyncIterator[dict]:
+        """
+        the whole history of the user in index order: archived messages, then the messages collection
+        """
+        count_db_read()
+        archived_indexes = set()
+        cursor = self.db[self.COLLECTION_NAME].find({"user_id": user_id}).sort("month", 1)
+        async for bucket in cursor:
+            for msg in self.decode(bucket):
+                archived_indexes.add(msg["index"])
+                yield msg
+
+        count_db_read()
+        cursor = self.db[MessageDAO.COLLECTION_NAME].find({"user_id": user_id}, {"_id": 0}).sort("index", 1)
+        async for msg in cursor:
+            if msg["index"] not in archived_indexes:
+                yield msg
+
+    async def stats(self) -> dict:
+        """number of buckets and messages, raw and stored payload sizes"""
+        pipeline = [{"$group": {
+            "_id": None,
+            "buckets": {"$sum": 1},
+            "messages": {"$sum": "$count"},
+            "raw_size": {"$sum": "$raw_size"},
+            "stored_size": {"$sum": "$stored_size"},
+        }}]
+        result = [r async for r in self.db[self.COLLECTION_NAME].aggregate(pipeline)]
+        return result[0] if result else {"buckets": 0, "messages": 0, "raw_size": 0, "stored_size": 0}
@@ -0,0 +1,83 @@
+import datetime
+
+from dao.base import BaseDBDAO
+from dao.indexes import IndexSpec
+from models.update_context import count_db_read
+
+
+class MessageDAO(BaseDBDAO):
+    """
+    Conversation history, one document per turn:
+    {user_id, index, role, content, content_tokens, voice_file_id, voice_duration, created_at, ...}
+    `tokens` of user messages is the prompt size of the turn, `content_tokens` the size of the message itself.
+    `index` is the position of the turn in the user's history (see UserDAO.append_messages),
+    `first_message_index` of the user document points into it.
+    """
+    COLLECTION_NAME = "messages"
+    INDEXES = [
+        IndexSpec([("user_id", 1), ("created_at", 1)]),
+        # dialog reads and UserDAO.get_talk_time("dialog")
+        IndexSpec([("user_id", 1), ("index", 1)]),
+        # analytics over all users
+        IndexSpec([("created_at", 1), ("role", 1)]),
+    ]
+
+    def __init__(self, app) -> None:
+        super().__init__(app)
+
+    def explain_queries(self) -> dict[str, dict]:
+        return {
+            "find_dialog": {"find": self.COLLECTION_NAME, "filter": {"user_id": 0, "index": {"$gte": 0}},
+                            "sort": {"index": 1}, "limit": 10},
+            "find_last": {"find": self.COLLECTION_NAME, "filter": {"user_id": 0}, "sort": {"index": -1}, "limit": 1},
+        }
+
+    async def insert_many(self, messages: list[dict]) -> list[dict]:
+        if messages:
+            await self.db[self.COLLECTION_NAME].insert_many(messages)
+        return messages
+
+    async def find_dialog(self, user_id: int, first_message_index: int = 0, limit: int = 0) -> list[dict]:
+        """
+        returns messages of the current dialog (starting from first_message_index) in chronological order
+        """
+        count_db_read()
+        cursor = self.db[self.COLLECTION_NAME].find(
+            {"user_id": user_id, "index": {"$gte": first_message_index}},
+            {"_id": 0}
+        ).sort("index", 1).limit(limit)
+        return [msg async for msg in cursor]
+
+    async def find_last(self, user_id: int, count: int = 1) -> list[dict]:
+        """
+        returns last <count> messages of the user in chronological order
+        """
+        count_db_read()
+        cursor = self.db[self.COLLECTION_NAME].find({"user_id": user_id}, {"_id": 0}).sort("index", -1).limit(count)
+        return [msg async for msg in cursor][::-1]
+
+    async def count(self, user_id: int) -> int:
+        count_db_read()
+        return await self.db[self.COLLECTION_NAME].count_documents({"user_id": user_id})
+
+    async def find_user_ids_before(self, before: datetime.datetime) -> list[int]:
+        """ids of users who have messages created before <before>"""
+        pipeline = [
+            {"$match": {"created_at": {"$lt": before}}},
+            {"$group": {"_id": "$user_id"}},
+        ]
+        return [r["_id"] async for r in self.db[self.COLLECTION_NAME].aggregate(pipeline, allowDiskUse=True)]
+
+    async def find_archivable(self, user_id: int, before: datetime.datetime,
+                              before_index: int | None = None) -> list[dict]:
+        """messages created before <before> with index below before_index (finished dialogs), with _id"""
+        query = {"user_id": user_id, "created_at": {"$lt": before}}
+        if before_index is not None:
+            query["index"] = {"$lt": before_index}
+        return [msg async for msg in self.db[self.COLLECTION_NAME].find(query).sort("index", 1)]
+
+    async def delete_by_ids(self, ids: list) -> int:
+        if not ids:
+            return 0
+        result = await self.db[self.COLLECTION_NAME].delete_many({"_id": {"$in": ids}})
+        return result.deleted_count
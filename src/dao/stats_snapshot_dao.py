@@ -0,0 +1,74 @@
+import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+from dao.base import BaseDBDAO
+from dao.indexes import IndexSpec
+
+# snapshots are rewritten on every refresh, the ones of removed metrics expire
+SNAPSHOT_TTL = 7 * 24 * 3600
+# marker document of the last periodic refresh, shared by the bot processes
+REFRESH_MARKER = {"metric": "_refresh", "interval": "all"}
+# one document per (metric, interval), claim_refresh relies on it to reject a second marker
+METRIC_INDEX = IndexSpec([("metric", 1), ("interval", 1)], unique=True)
+
+
+class StatsSnapshotDAO(BaseDBDAO):
+    """
+    Precomputed admin analytics: {metric, interval, value, computed_at}
+    Filled by utils.analytics.refresh_stats_snapshots
+    """
+    COLLECTION_NAME = "stats_snapshots"
+    INDEXES = [
+        METRIC_INDEX,
+        IndexSpec([("computed_at", 1)], ttl=SNAPSHOT_TTL),
+    ]
+
+    def __init__(self, app) -> None:
+        super().__init__(app)
+
+
+    async def save(self, metric: str, interval: str, value) -> None:
+        await self.db[self.COLLECTION_NAME].update_one(
+            {"metric": metric, "interval": interval},
+            {"$set": {"value": value, "computed_at": datetime.datetime.now()}},
+            upsert=True
+        )
+
+    async def get(self, metric: str, interval: str) -> dict | None:
+        """returns {"value": ..., "computed_at": datetime} or None if the metric was not computed yet"""
+        return await self.db[self.COLLECTION_NAME].find_one(
+            {"metric": metric, "interval": interval}, {"_id": 0, "value": 1, "computed_at": 1}
+        )
+
+    async def check_claim_index(self) -> None:
+        """raises if the unique (metric, interval) index is missing (mongodb.ensure_indexes off), checked at startup"""
+        indexes = await self.db[self.COLLECTION_NAME].index_information()
+        if not any(info.get("unique") and [tuple(key) for key in info["key"]] == METRIC_INDEX.keys
+                   for info in indexes.values()):
+            raise RuntimeError(f"{self.COLLECTION_NAME}: unique index {METRIC_INDEX.name} is missing, "
+                               f"claim_refresh needs it (python3 manage.py indexes)")
+
+    async def claim_refresh(self, refresh_interval: float) -> bool:
+        """
+        True if the last periodic refresh is older than refresh_interval seconds, the refresh is then claimed
+        by this process: other processes and restarts get False until the interval passes again.
+        Needs the unique METRIC_INDEX, see check_claim_index
+        """
+        now = datetime.datetime.now()
+        try:
+            await self.db[self.COLLECTION_NAME].update_one(
+                {**REFRESH_MARKER, "computed_at": {"$lt": now - datetime.timedelta(seconds=refresh_interval)}},
+                {"$set": {"computed_at": now}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # the marker exists and is fresh, the upsert tried to insert a second one
+            return False
+        return True
+
+    async def get_all(self) -> list[dict]:
+        cursor = self.db[self.COLLECTION_NAME].find(
+            {"metric": {"$ne": REFRESH_MARKER["metric"]}}, {"_id": 0}
+        ).sort([("metric", 1), ("interval", 1)])
+        return [snapshot async for snapshot in cursor]
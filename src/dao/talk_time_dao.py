@@ -0,0 +1,178 @@
+import datetime
+from collections import defaultdict
+
+from pymongo import UpdateOne
+
+from dao.base import BaseDBDAO
+from dao.indexes import IndexSpec
+from dao.message_archive_dao import MessageArchiveDAO
+from dao.message_dao import MessageDAO
+from models.update_context import count_db_read
+
+ROLES = ("user", "assistant")
+
+
+class TalkTimeRollupDAO(BaseDBDAO):
+    """
+    Per user, per day usage counters maintained on write:
+    {user_id, date, talk_time: {user, assistant}, messages: {user, assistant}, tokens}
+    talk_time is in seconds, date is the local midnight of the day
+    """
+    COLLECTION_NAME = "talk_time_daily"
+    INDEXES = [
+        IndexSpec([("user_id", 1), ("date", 1)], unique=True),
+        # leaderboard rebuild, get_totals_since
+        IndexSpec([("date", 1)]),
+    ]
+
+    def __init__(self, app) -> None:
+        super().__init__(app)
+
+    def explain_queries(self) -> dict[str, dict]:
+        week_ago = datetime.datetime.combine(datetime.date.today(), datetime.time.min) - datetime.timedelta(days=7)
+        return {
+            "get_sums": {"aggregate": self.COLLECTION_NAME, "pipeline": self._sums_pipeline(0, week_ago), "cursor": {}},
+            "get_totals_since": {"aggregate": self.COLLECTION_NAME, "pipeline": self._totals_pipeline(week_ago),
+                                 "cursor": {}},
+        }
+
+    async def add_messages(self, user_id: int, messages: list[dict]) -> None:
+        increments = defaultdict(lambda: defaultdict(int))
+        for msg in messages:
+            if msg.get("role") not in ROLES:
+                continue
+            day = datetime.datetime.combine(msg["created_at"].date(), datetime.time.min)
+            increments[day][f"talk_time.{msg['role']}"] += msg.get("voice_duration") or 0
+            increments[day][f"messages.{msg['role']}"] += 1
+            increments[day]["tokens"] += msg.get("tokens") or 0
+
+        if increments:
+            await self.db[self.COLLECTION_NAME].bulk_write([
+                UpdateOne({"user_id": user_id, "date": day}, {"$inc": dict(inc)}, upsert=True)
+                for day, inc in increments.items()
+            ], ordered=False)
+
+    async def insert_many(self, rollups: list[dict]) -> None:
+        """bulk insert of complete day documents of users without rollups yet (seeding)"""
+        if rollups:
+            await self.db[self.COLLECTION_NAME].insert_many(rollups, ordered=False)
+
+    async def get_sums(self, user_id: int, start: datetime.datetime | None = None,
+                       end: datetime.datetime | None = None) -> dict:
+        """
+        returns {"talk_time": {"user": sec, "assistant": sec}, "messages": {"user": n, "assistant": n}, "tokens": n}
+        for the days in [start, end)
+        """
+        count_db_read()
+        cursor = self.db[self.COLLECTION_NAME].aggregate(self._sums_pipeline(user_id, start, end))
+        result = [r async for r in cursor]
+        result = result[0] if result else {}
+        return {
+            "talk_time": {role: result.get(f"talk_time_{role}", 0) for role in ROLES},
+            "messages": {role: result.get(f"messages_{role}", 0) for role in ROLES},
+            "tokens": result.get("tokens", 0),
+        }
+
+    def _sums_pipeline(self, user_id: int, start: datetime.datetime | None = None,
+                       end: datetime.datetime | None = None) -> list[dict]:
+        match = {"user_id": user_id}
+        if start is not None or end is not None:
+            match["date"] = {}
+        if start is not None:
+            match["date"]["$gte"] = start
+        if end is not None:
+            match["date"]["$lt"] = end
+
+        return [
+            {"$match": match},
+            {"$group": {
+                "_id": "$user_id",
+                **{f"talk_time_{role}": {"$sum": f"$talk_time.{role}"} for role in ROLES},
+                **{f"messages_{role}": {"$sum": f"$messages.{role}"} for role in ROLES},
+                "tokens": {"$sum": "$tokens"},
+            }}
+        ]
+
+    async def get_totals_since(self, start: datetime.datetime, role: str = "user") -> dict[int, float]:
+        """returns {user_id: talk seconds} of all users since start"""
+        cursor = self.db[self.COLLECTION_NAME].aggregate(self._totals_pipeline(start, role))
+        return {r["_id"]: r["talk_time"] async for r in cursor}
+
+    def _totals_pipeline(self, start: datetime.datetime, role: str = "user") -> list[dict]:
+        return [
+            {"$match": {"date": {"$gte": start}}},
+            {"$group": {"_id": "$user_id", "talk_time": {"$sum": f"$talk_time.{role}"}}},
+        ]
+
+    async def rebuild(self, user_id: int | None = None) -> None:
+        """
+        Backfill: recomputes the rollups from the messages collection and the archive bucket headers
+        """
+        match = {"role": {"$in": list(ROLES)}}
+        if user_id is not None:
+            match["user_id"] = user_id
+            await self.db[self.COLLECTION_NAME].delete_many({"user_id": user_id})
+        else:
+            await self.db[self.COLLECTION_NAME].delete_many({})
+
+        day = {"$dateFromParts": {
+            "year": {"$year": "$created_at"},
+            "month": {"$month": "$created_at"},
+            "day": {"$dayOfMonth": "$created_at"},
+        }}
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {"user_id": "$user_id", "date": day},
+                **{f"talk_time_{role}": {"$sum": {"$cond": [{"$eq": ["$role", role]}, "$voice_duration", 0]}}
+                   for role in ROLES},
+                **{f"messages_{role}": {"$sum": {"$cond": [{"$eq": ["$role", role]}, 1, 0]}}
+                   for role in ROLES},
+                "tokens": {"$sum": {"$ifNull": ["$tokens", 0]}},
+            }},
+            {"$project": {
+                "_id": 0,
+                "user_id": "$_id.user_id",
+                "date": "$_id.date",
+                "talk_time": {role: f"$talk_time_{role}" for role in ROLES},
+                "messages": {role: f"$messages_{role}" for role in ROLES},
+                "tokens": 1,
+            }},
+            {"$merge": {
+                "into": self.COLLECTION_NAME,
+                "on": ["user_id", "date"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }},
+        ]
+        async for _ in self.db[MessageDAO.COLLECTION_NAME].aggregate(pipeline, allowDiskUse=True):
+            pass
+
+        # archived days, added to the hot part of the day if a dialog was finished in the middle of it
+        archive_match = {"user_id": user_id} if user_id is not None else {}
+        archive_pipeline = [
+            {"$match": archive_match},
+            {"$unwind": "$days"},
+            {"$project": {
+                "_id": 0,
+                "user_id": 1,
+                "date": "$days.date",
+                "talk_time": "$days.talk_time",
+                "messages": "$days.messages",
+                "tokens": "$days.tokens",
+            }},
+            {"$merge": {
+                "into": self.COLLECTION_NAME,
+                "on": ["user_id", "date"],
+                "whenMatched": [{"$set": {
+                    **{f"talk_time.{role}": {"$add": [f"$talk_time.{role}", f"$$new.talk_time.{role}"]}
+                       for role in ROLES},
+                    **{f"messages.{role}": {"$add": [f"$messages.{role}", f"$$new.messages.{role}"]}
+                       for role in ROLES},
+                    "tokens": {"$add": ["$tokens", "$$new.tokens"]},
+                }}],
+                "whenNotMatched": "insert",
+            }},
+        ]
+        async for _ in self.db[MessageArchiveDAO.COLLECTION_NAME].aggregate(archive_pipeline, allowDiskUse=True):
+            pass
@@ -0,0 +1,65 @@
+import datetime
+import hashlib
+import unicodedata
+
+from dao.base import BaseDBDAO
+from dao.indexes import IndexSpec
+from models.update_context import count_db_read
+from utils.cache import MISSING, TTLCache
+
+# translations of user texts are not kept longer, frequent ones are translated again after it
+TRANSLATION_TTL = 30 * 24 * 3600
+
+
+def normalize_text(text: str) -> str:
+    """the same text typed or transcribed with other whitespace or unicode forms gets the same key"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def translation_key(text: str, language: str) -> str:
+    return hashlib.sha256(f"{language}\n{normalize_text(text)}".encode()).hexdigest()
+
+
+class TranslationDAO(BaseDBDAO):
+    """
+    Translations shared by all users: {key, language, text, created_at},
+    key = sha256 of the target language and the normalized source text, the source itself is not stored.
+    Documents expire TRANSLATION_TTL after created_at.
+    Recently used translations are kept in memory (cache.translations)
+    """
+    COLLECTION_NAME = "translations"
+    INDEXES = [
+        IndexSpec([("key", 1)], unique=True),
+        IndexSpec([("created_at", 1)], ttl=TRANSLATION_TTL),
+    ]
+
+    def __init__(self, app) -> None:
+        super().__init__(app)
+        cache_config = app["config"].get("cache", {}).get("translations", {})
+        # translations don't change, ttl only bounds memory of rarely used ones
+        self.cache = TTLCache(max_size=cache_config.get("max_size", 10000), ttl=cache_config.get("ttl"))
+
+    async def get(self, text: str, language: str = "ru") -> str | None:
+        key = translation_key(text, language)
+        translation = self.cache.get(key)
+        if translation is not MISSING:
+            return translation
+
+        count_db_read()
+        record = await self.db[self.COLLECTION_NAME].find_one({"key": key}, {"_id": 0, "text": 1})
+        if record is None:
+            return None
+        self.cache.set(key, record["text"])
+        return record["text"]
+
+    async def save(self, text: str, translation: str, language: str = "ru") -> None:
+        key = translation_key(text, language)
+        self.cache.set(key, translation)
+        await self.db[self.COLLECTION_NAME].update_one(
+            {"key": key},
+            {"$setOnInsert": {"language": language, "text": translation, "created_at": datetime.datetime.now()}},
+            upsert=True
+        )
+
+    def cache_stats(self) -> dict:
+        return self.cache.stats()
@@ -1,91 +1,475 @@
 import datetime
-import random
-import numpy as np
-import string
-import uuid
 import asyncio
 import csv
+import os
+import re
+import zoneinfo
+from copy import deepcopy
+from pymongo import ReturnDocument
 from dao.base import BaseDBDAO
-from utils.structures import UserData
+from dao.indexes import IndexSpec
+from dao.message_archive_dao import MessageArchiveDAO
+from dao.message_dao import MessageDAO
+from models.update_context import get_update_context, count_db_read
+from utils.cache import TTLCache, MISSING
+from utils.stats import counts_to_arrays, cumulative_counts, weighted_percentiles
+from utils import tokens
+from utils.tokens import message_tokens
+
+
+# granularity: ($dateToString format of the bucket key, bucket length)
+HISTOGRAM_GRANULARITY = {
+    "hour": ("%Y-%m-%dT%H", datetime.timedelta(hours=1)),
+    "day": ("%Y-%m-%d", datetime.timedelta(days=1)),
+    "week": ("%G-W%V", datetime.timedelta(weeks=1)),
+}
 
 
 class UserDAO(BaseDBDAO):
     COLLECTION_NAME = "user"
+    MESSAGES_COLLECTION_NAME = MessageDAO.COLLECTION_NAME
+    INDEXES = [
+        IndexSpec([("user_id", 1)], unique=True),
+        # get_new_users_by_interval
+        IndexSpec([("subscription_start_date", 1)]),
+        # find_users_without_renewed_premium, covers premium users only
+        IndexSpec([("subscription", 1), ("subscription_start_date", 1)], partial={"subscription": "premium"}),
+    ]
 
     def __init__(self, app) -> None:
         super().__init__(app)
+        self.app = app
+
+        cache_config = app["config"].get("cache", {}).get("user", {})
+        self.cache: TTLCache | None = None
+        if cache_config.get("enabled"):
+            self.cache = TTLCache(max_size=cache_config.get("max_size", 10000), ttl=cache_config.get("ttl", 60))
 
-    async def async_init(self) -> None:
-        await self.db[self.COLLECTION_NAME].create_index("user_id")
+        # membership results of is_known(), mongo stays the source of truth
+        known_config = app["config"].get("cache", {}).get("known_users", {})
+        self.known_users = TTLCache(max_size=known_config.get("max_size", 100000),
+                                    ttl=known_config.get("ttl", 3600))
+        self.unknown_users = TTLCache(max_size=known_config.get("max_size", 100000),
+                                      ttl=known_config.get("negative_ttl", 30))
+
+    def explain_queries(self) -> dict[str, dict]:
+        return {
+            "find_by_user_id": {"find": self.COLLECTION_NAME, "filter": {"user_id": 0}, "limit": 1},
+            "find_users_without_renewed_premium": {"find": self.COLLECTION_NAME, "filter": self._renewal_filter()},
+            "get_new_users_by_interval": {"aggregate": self.COLLECTION_NAME,
+                                          "pipeline": self._new_users_pipeline(datetime.date.today()), "cursor": {}},
+            "get_talk_time_dialog": {"aggregate": self.MESSAGES_COLLECTION_NAME,
+                                     "pipeline": self._dialog_talk_time_pipeline(0, 0), "cursor": {}},
+        }
 
-    async def create(self, data):
-        await self.db[self.COLLECTION_NAME].insert_one(data)
+    async def create(self, data) -> dict | None:
+        """
+        inserts the user unless a document with the user_id exists (a concurrent /start, another process),
+        returns None then and the existing document is kept
+        """
+        result = await self.db[self.COLLECTION_NAME].update_one(
+            {"user_id": data["user_id"]}, {"$setOnInsert": data}, upsert=True
+        )
+        if result.upserted_id is None:
+            self.known_users.set(data["user_id"], True)
+            self.unknown_users.pop(data["user_id"])
+            return None
+        document = pop_internal_fields(deepcopy(data))
+        context = get_update_context()
+        if context is not None:
+            context.users[data["user_id"]] = deepcopy(document)
+        if self.cache is not None:
+            self.cache.set(data["user_id"], document)
+        self.known_users.set(data["user_id"], True)
+        self.unknown_users.pop(data["user_id"])
         return data
 
+    async def insert_many(self, users: list[dict]) -> None:
+        """bulk insert of new users (seeding, imports), bypasses the caches"""
+        if users:
+            await self.db[self.COLLECTION_NAME].insert_many(users, ordered=False)
+
     async def update(self, data):
         await self.db[self.COLLECTION_NAME].update_one({"user_id": data["user_id"]}, {"$set": data}, upsert=True)
+        self._update_snapshot(data["user_id"], set_fields=data)
         return data
 
     async def find_by_user_id(self, user_telegram_id: int) -> dict:
-        return await self.db[self.COLLECTION_NAME].find_one({"user_id": user_telegram_id}, {"_id": 0})
+        """
+        Inside of a telegram update the document is read once and then served from the update context.
+        Between updates it is served from the in-process cache (if enabled in config).
+        Returned dict is a copy, changes have to be saved with update()
+        """
+        context = get_update_context()
+        if context is not None and user_telegram_id in context.users:
+            return deepcopy(context.users[user_telegram_id])
+
+        data = self.cache.get(user_telegram_id) if self.cache is not None else MISSING
+        if data is MISSING:
+            count_db_read()
+            # legacy documents may still hold the embedded history, it lives in the messages collection now
+            data = await self.db[self.COLLECTION_NAME].find_one({"user_id": user_telegram_id}, {"_id": 0, "messages": 0})
+            if self.cache is not None and data is not None:
+                self.cache.set(user_telegram_id, deepcopy(data))
+
+        if context is not None:
+            context.users[user_telegram_id] = deepcopy(data)
+        return deepcopy(data)
+
+    async def find_fields(self, user_telegram_id: int, fields: list[str]) -> dict | None:
+        """
+        returns only the requested fields of the user document (missing fields are absent in the result).
+        Uses the full document if it is already loaded, otherwise reads a projection
+        """
+        context = get_update_context()
+        full_document = MISSING
+        if context is not None and user_telegram_id in context.users:
+            full_document = context.users[user_telegram_id]
+        elif self.cache is not None:
+            full_document = self.cache.get(user_telegram_id)
+        if full_document is not MISSING:
+            if full_document is None:
+                return None
+            return deepcopy({field: full_document[field] for field in fields if field in full_document})
+
+        partial = context.partial_users.get(user_telegram_id) if context is not None else None
+        if partial is not None and all(field in partial["loaded_fields"] for field in fields):
+            return deepcopy({field: partial["data"][field] for field in fields if field in partial["data"]})
+
+        count_db_read()
+        data = await self.db[self.COLLECTION_NAME].find_one(
+            {"user_id": user_telegram_id},
+            {"_id": 0, **{field: 1 for field in fields}}
+        )
+        if data is not None and context is not None:
+            partial = context.partial_users.setdefault(user_telegram_id, {"loaded_fields": set(), "data": {}})
+            partial["loaded_fields"].update(fields)
+            partial["data"].update(deepcopy(data))
+        return data
 
-    # async def find_all_by_user_id(self, user_telegram_id: int) -> dict:
-    #     return self.db[self.COLLECTION_NAME].find({"user_id": user_telegram_id}, {"_id": 0})
+    async def get_messages_count(self, user_telegram_id: int) -> int:
+        """number of stored messages without transferring them"""
+        data = await self.find_fields(user_telegram_id, ["messages_count"]) or {}
+        return data.get("messages_count", 0)
 
-    async def find_known_users_ids(self) -> set:
+    async def find_last_messages(self, user_telegram_id: int, count: int = 1) -> list[dict]:
+        """
+        last <count> messages in chronological order.
+        The history is stored in the messages collection, so it is a sorted index scan instead of $slice
+        """
+        return await self.app.Dao.message.find_last(user_telegram_id, count)
+
+    def invalidate(self, user_telegram_id: int) -> None:
+        """drops cached document, use it after writing to the user collection bypassing UserDAO"""
+        if self.cache is not None:
+            self.cache.pop(user_telegram_id)
+        context = get_update_context()
+        if context is not None:
+            context.users.pop(user_telegram_id, None)
+            context.partial_users.pop(user_telegram_id, None)
+
+    def cache_stats(self) -> dict:
+        """hit/miss/eviction counters of the user document cache and the known users caches"""
         return {
-            int(obj["user_id"])
-            async for obj in self.db[self.COLLECTION_NAME].find({}, {"user_id": 1})
+            "users": self.cache.stats() if self.cache is not None else None,
+            "known_users": self.known_users.stats(),
+            "unknown_users": self.unknown_users.stats(),
         }
 
+    def _update_snapshot(self, user_telegram_id: int, set_fields: dict | None = None, inc_fields: dict | None = None):
+        """write-through: keeps the documents shared in the update context and the cache in sync with the writes"""
+        snapshots = []
+        context = get_update_context()
+        if context is not None and context.users.get(user_telegram_id) is not None:
+            snapshots.append(context.users[user_telegram_id])
+        if context is not None and user_telegram_id in context.partial_users:
+            partial = context.partial_users[user_telegram_id]
+            partial["loaded_fields"].update(set_fields or {})
+            # increments of not loaded fields can't be applied, the field has to be read again
+            partial["loaded_fields"].difference_update(
+                key for key in (inc_fields or {}) if key not in partial["data"]
+            )
+            snapshots.append(partial["data"])
+        if self.cache is not None:
+            cached = self.cache.peek(user_telegram_id)
+            if cached is not MISSING:
+                snapshots.append(cached)
+                # refresh the entry ttl and LRU position
+                self.cache.set(user_telegram_id, cached)
+
+        for snapshot in snapshots:
+            snapshot.update(deepcopy(set_fields or {}))
+            for key, value in (inc_fields or {}).items():
+                snapshot[key] = snapshot.get(key, 0) + value
+
+    async def append_messages(self, user_telegram_id: int, messages: list[dict]) -> list[dict]:
+        """
+        Appends turns to the user's history. Every message is stored as a separate document
+        of the messages collection, the user document only keeps the messages_count counter.
+        content_tokens is counted here unless the caller already counted it, so prompt sizes are sums of stored counts.
+        """
+        user = await self.db[self.COLLECTION_NAME].find_one_and_update(
+            {"user_id": user_telegram_id},
+            {"$inc": {"messages_count": len(messages)}},
+            projection={"_id": 0, "messages_count": 1},
+            return_document=ReturnDocument.AFTER,
+            upsert=True
+        )
+        self._update_snapshot(user_telegram_id, set_fields={"messages_count": user["messages_count"]})
+        first_index = user["messages_count"] - len(messages)
+        documents = [{**msg, "user_id": user_telegram_id, "index": first_index + i} for i, msg in enumerate(messages)]
+        for msg in documents:
+            # estimated counts are not stored: the prompt size stays unset, content_tokens is counted later
+            if msg.get("tokens") is None:
+                msg.pop("tokens", None)
+            if tokens.available():
+                msg["content_tokens"] = message_tokens(msg)
+            else:
+                msg.pop("content_tokens", None)
+        await self.app.Dao.message.insert_many(documents)
+        await self.app.Dao.talk_time.add_messages(user_telegram_id, documents)
+        for msg in documents:
+            if msg.get("role") == "user":
+                self.app.Managers.leaderboard.add(user_telegram_id, msg.get("voice_duration") or 0, msg["created_at"])
+        return documents
+
+    async def migrate_embedded_messages(self) -> int:
+        """
+        Moves the legacy embedded `messages` arrays to the messages collection.
+        Safe to run while the bot serves and to run again after an interruption:
+        1. once per user, atomically: messages_count += len(legacy), the previous counter (turns already appended
+           to the messages collection) and the legacy length are remembered in `legacy_migration`;
+        2. those appended turns are shifted by len(legacy) (each one once, marked with legacy_shifted),
+           turns appended after step 1 already get the shifted indexes;
+        3. legacy turns are (re)inserted with indexes 0..n-1 and `legacy: true`, rollups of the user are rebuilt;
+        4. `messages` and `legacy_migration` are removed, then the legacy_shifted marks.
+        returns the number of migrated users
+        """
+        migrated = 0
+        cursor = self.db[self.COLLECTION_NAME].find({"messages.0": {"$exists": True}}, {"user_id": 1, "messages": 1})
+        async for user in cursor:
+            user_id, legacy = user["user_id"], user["messages"]
+
+            # step 1, a pipeline update so the previous counter is read and replaced atomically
+            count = {"$ifNull": ["$messages_count", 0]}
+            first_index = {"$ifNull": ["$first_message_index", 0]}
+            await self.db[self.COLLECTION_NAME].update_one(
+                {"_id": user["_id"], "legacy_migration": {"$exists": False}},
+                [{"$set": {
+                    "legacy_migration": {"count": len(legacy), "appended": count},
+                    "messages_count": {"$add": [count, len(legacy)]},
+                    # a dialog started after the upgrade points into the appended turns, older ones into the legacy
+                    "first_message_index": {"$cond": [
+                        {"$and": [{"$gt": [count, 0]}, {"$lte": [first_index, count]}]},
+                        {"$add": [first_index, len(legacy)]},
+                        first_index,
+                    ]},
+                }}]
+            )
+            state = (await self.db[self.COLLECTION_NAME].find_one(
+                {"_id": user["_id"]}, {"legacy_migration": 1}
+            ))["legacy_migration"]
+
+            # step 2
+            await self.db[self.MESSAGES_COLLECTION_NAME].update_many(
+                {"user_id": user_id, "legacy": {"$ne": True}, "legacy_shifted": {"$ne": True},
+                 "index": {"$lt": state["appended"]}},
+                {"$inc": {"index": state["count"]}, "$set": {"legacy_shifted": True}}
+            )
+
+            # step 3
+            await self.db[self.MESSAGES_COLLECTION_NAME].delete_many({"user_id": user_id, "legacy": True})
+            await self.app.Dao.message.insert_many([
+                {**msg, "user_id": user_id, "index": i, "legacy": True}
+                for i, msg in enumerate(legacy[:state["count"]])
+            ])
+            await self.app.Dao.talk_time.rebuild(user_id)
+
+            # step 4, the user is done first: a rerun must not shift the unmarked turns again
+            await self.db[self.COLLECTION_NAME].update_one(
+                {"_id": user["_id"]}, {"$unset": {"messages": "", "legacy_migration": ""}}
+            )
+            await self.db[self.MESSAGES_COLLECTION_NAME].update_many(
+                {"user_id": user_id, "legacy_shifted": True}, {"$unset": {"legacy_shifted": ""}}
+            )
+            self.invalidate(user_id)
+            migrated += 1
+        return migrated
+
+    async def archive_old_messages(self, max_age_days: int | None = None, batch_size: int = 1000) -> dict:
+        """
+        Moves messages of finished dialogs (index below first_message_index) older than max_age_days
+        to the message_archive buckets. The current dialog always stays in the messages collection.
+        returns {"users": n, "messages": n}
+        """
+        if max_age_days is None:
+            max_age_days = self.app["config"].get("archive", {}).get("max_age_days", 180)
+        before = datetime.datetime.combine(datetime.date.today(), datetime.time.min) \
+            - datetime.timedelta(days=max_age_days)
+
+        totals = {"users": 0, "messages": 0}
+        user_ids = await self.app.Dao.message.find_user_ids_before(before)
+        for i in range(0, len(user_ids), batch_size):
+            batch = user_ids[i:i + batch_size]
+            first_indexes = {
+                user["user_id"]: user.get("first_message_index", 0)
+                async for user in self.db[self.COLLECTION_NAME].find(
+                    {"user_id": {"$in": batch}}, {"_id": 0, "user_id": 1, "first_message_index": 1}
+                )
+            }
+            for user_id in batch:
+                # history of deleted users has no current dialog
+                messages = await self.app.Dao.message.find_archivable(user_id, before, first_indexes.get(user_id))
+                if not messages:
+                    continue
+                await self.app.Dao.message_archive.archive(user_id, messages)
+                await self.app.Dao.message.delete_by_ids([msg["_id"] for msg in messages])
+                totals["users"] += 1
+                totals["messages"] += len(messages)
+        return totals
+
+    def _archive_union(self, cutoff: datetime.datetime, pipeline: list[dict]) -> list[dict]:
+        """
+        $unionWith stage adding the archive buckets created after cutoff to an analytics pipeline.
+        Messages younger than archive.max_age_days are never archived, shorter intervals skip the archive
+        """
+        max_age_days = self.app["config"].get("archive", {}).get("max_age_days", 180)
+        if cutoff >= datetime.datetime.now() - datetime.timedelta(days=max_age_days):
+            return []
+        return [{"$unionWith": {
+            "coll": MessageArchiveDAO.COLLECTION_NAME,
+            "pipeline": [{"$match": {"first_created_at": {"$gte": cutoff}}}, *pipeline],
+        }}]
+
+    # async def find_all_by_user_id(self, user_telegram_id: int) -> dict:
+    #     return self.db[self.COLLECTION_NAME].find({"user_id": user_telegram_id}, {"_id": 0})
+
+    async def is_known(self, user_telegram_id: int) -> bool:
+        """
+        checks that the user document exists.
+        Positive and negative results are cached, negative ones for a short time only
+        because another bot process may create the user
+        """
+        context = get_update_context()
+        if context is not None and context.users.get(user_telegram_id) is not None:
+            return True
+        if self.cache is not None and self.cache.peek(user_telegram_id) not in (MISSING, None):
+            return True
+        if self.known_users.get(user_telegram_id) is not MISSING:
+            return True
+        if self.unknown_users.get(user_telegram_id) is not MISSING:
+            return False
+
+        count_db_read()
+        is_known = await self.db[self.COLLECTION_NAME].count_documents({"user_id": user_telegram_id}, limit=1) > 0
+        if is_known:
+            self.known_users.set(user_telegram_id, True)
+        else:
+            self.unknown_users.set(user_telegram_id, True)
+        return is_known
+
     async def find_users_without_renewed_premium(self):
         """
         returns a list of users who are about to renew their premium.
         either automatically or manually
         """
-        return [obj async for obj in self.db[self.COLLECTION_NAME].find({
+        return [obj async for obj in self.db[self.COLLECTION_NAME].find(self._renewal_filter())]
+
+    def _renewal_filter(self) -> dict:
+        return {
             "subscription": {"$eq": "premium"},
             "subscription_start_date": {
                 "$lt": datetime.datetime.combine(datetime.datetime.utcnow(), datetime.time.min) - datetime.timedelta(days=30)
             }
-        })]
+        }
 
     async def increment_generations(self, user_telegram_id: int):
-        return await self.db[self.COLLECTION_NAME].update_one({"user_id": user_telegram_id},
-                                                              {"$inc": {"generations": 1, "today_generations": 1}},
-                                                              upsert=True)
+        result = await self.db[self.COLLECTION_NAME].update_one({"user_id": user_telegram_id},
+                                                                {"$inc": {"generations": 1, "today_generations": 1}},
+                                                                upsert=True)
+        self._update_snapshot(user_telegram_id, inc_fields={"generations": 1, "today_generations": 1})
+        return result
 
     async def reset_today_generations(self, user_telegram_id: int):
-        return await self.db[self.COLLECTION_NAME].update_many(
+        reset_fields = {
+            "today_generations": 0,
+            "last_generation_date": datetime.datetime.combine(datetime.datetime.utcnow(), datetime.time.min)
+        }
+        result = await self.db[self.COLLECTION_NAME].update_many(
             {
                 "user_id": user_telegram_id
             },
             {
-                "$set": {
-                    "today_generations": 0,
-                    "last_generation_date": datetime.datetime.combine(datetime.datetime.utcnow(), datetime.time.min)}
+                "$set": reset_fields
             }
         )
+        self._update_snapshot(user_telegram_id, set_fields=reset_fields)
+        return result
 
     async def get_usage_in_interval(self, user_id, datetime1, datetime2):
-        pipeline_total = [
-            {"$unwind": "$messages"},
+        """
+        returns talk time (in minutes) of the user in the days from datetime1 (inclusive) to datetime2 (exclusive).
+        Computed from the daily rollups, so the bounds are days
+        """
+        sums = await self.app.Dao.talk_time.get_sums(user_id, datetime1, datetime2)
+        user_talk_time_min = round(sums["talk_time"]["user"] / 60, 1)
+        return user_talk_time_min
+
+    async def get_usage_histogram(self, user_id, start: datetime.datetime, end: datetime.datetime,
+                                  granularity="day", timezone: str | None = None, role="user"):
+        """
+        granularity: hour, day, week (ISO weeks, starting on monday)
+        timezone: Olson name or offset ("Europe/Moscow", "+03:00") of the buckets, None - the server clock.
+            created_at is stored as the server local time, it is converted to the timezone in the aggregation;
+            naive start/end are wall times of the timezone, aware ones are converted to it
+        returns every bucket of [start, end) in one aggregation:
+            [{"start": datetime, "talk_time": minutes, "voice_count": n}, ...]
+        """
+        if granularity not in HISTOGRAM_GRANULARITY:
+            raise ValueError(f"granularity must be one of {list(HISTOGRAM_GRANULARITY)}")
+        key_format, step = HISTOGRAM_GRANULARITY[granularity]
+
+        bucket_date = "$created_at"
+        match_start, match_end = start, end
+        if timezone is not None:
+            tz = parse_timezone(timezone)
+            start, end = to_wall_time(start, tz), to_wall_time(end, tz)
+            # the bounds in the server local time of created_at
+            match_start, match_end = (dt.replace(tzinfo=tz).astimezone().replace(tzinfo=None) for dt in (start, end))
+            bucket_date = server_local_to_instant("$created_at")
+
+        date_to_string = {"format": key_format, "date": bucket_date}
+        if timezone is not None:
+            date_to_string["timezone"] = timezone
+        pipeline = [
             {"$match": {
                 "user_id": user_id,
-                "messages.role": "user",
-                "messages.created_at": {"$gte": datetime1, "$lte": datetime2}
+                "created_at": {"$gte": match_start, "$lt": match_end},
+                "role": role
             }},
             {"$group": {
-                "_id": "$user_id",
-                "talk_time": {"$sum": "$messages.voice_duration"}
-            }},
-            {"$limit": 1}
+                "_id": {"$dateToString": date_to_string},
+                "talk_time": {"$sum": "$voice_duration"},
+                "voice_count": {"$sum": 1}
+            }}
         ]
-        users_cursor = self.db[self.COLLECTION_NAME].aggregate(pipeline_total)
-        user_result = [user async for user in users_cursor]
-        user_result = user_result[0] if len(user_result) == 1 else {"talk_time": 0}
-        user_talk_time_min = round(user_result["talk_time"] / 60, 1)
-        return user_talk_time_min
+        count_db_read()
+        buckets = {
+            bucket["_id"]: bucket
+            async for bucket in self.db[self.MESSAGES_COLLECTION_NAME].aggregate(pipeline)
+        }
+
+        histogram = []
+        bucket_start = truncate_datetime(start, granularity)
+        while bucket_start < end:
+            bucket = buckets.get(bucket_start.strftime(key_format), {})
+            histogram.append({
+                "start": bucket_start,
+                "talk_time": round(bucket.get("talk_time", 0) / 60, 1),
+                "voice_count": bucket.get("voice_count", 0)
+            })
+            bucket_start += step
+        return histogram
 
     async def get_usage_by_weekday(self, user_id):
         """
@@ -96,42 +480,14 @@ class UserDAO(BaseDBDAO):
         week_start = today - datetime.timedelta(days=today.weekday())
         # date -> datetime conversion
         week_start = datetime.datetime.combine(week_start, datetime.time.min)
-        mon_start = week_start
-        mon_end = mon_start + datetime.timedelta(days=1)
-        mon = {"talk_time": await self.get_usage_in_interval(user_id, mon_start, mon_end)}
-
-        tue_start = mon_end
-        tue_end = tue_start + datetime.timedelta(days=1)
-        tue = {"talk_time": await self.get_usage_in_interval(user_id, tue_start, tue_end)}
-
-        wed_start = tue_end
-        wed_end = wed_start + datetime.timedelta(days=1)
-        wed = {"talk_time": await self.get_usage_in_interval(user_id, wed_start, wed_end)}
+        week_end = week_start + datetime.timedelta(days=7)
 
-        thu_start = wed_end
-        thu_end = thu_start + datetime.timedelta(days=1)
-        thu = {"talk_time": await self.get_usage_in_interval(user_id, thu_start, thu_end)}
-
-        fri_start = thu_end
-        fri_end = fri_start + datetime.timedelta(days=1)
-        fri = {"talk_time": await self.get_usage_in_interval(user_id, fri_start, fri_end)}
-
-        sat_start = fri_end
-        sat_end = sat_start + datetime.timedelta(days=1)
-        sat = {"talk_time": await self.get_usage_in_interval(user_id, sat_start, sat_end)}
-
-        sun_start = sat_end
-        sun_end = sun_start + datetime.timedelta(days=1)
-        sun = {"talk_time": await self.get_usage_in_interval(user_id, sun_start, sun_end)}
+        histogram = await self.get_usage_histogram(user_id, week_start, week_end, granularity="day")
 
+        weekdays = ["mon", "tue", "wen", "thu", "fri", "sat", "sun"]
         return {
-            "mon": mon,
-            "tue": tue,
-            "wen": wed,
-            "thu": thu,
-            "fri": fri,
-            "sat": sat,
-            "sun": sun
+            weekday: {"talk_time": bucket["talk_time"]}
+            for weekday, bucket in zip(weekdays, histogram)
         }
 
     async def get_talk_time(self, user_id, interval="day", role = 'user'):
@@ -156,62 +512,33 @@ class UserDAO(BaseDBDAO):
                 cutoff_date = today - datetime.timedelta(days=365 * 100)
             # convert date to datetime
             cutoff_date = datetime.datetime.combine(cutoff_date, datetime.time.min)
-            pipeline_total = [
-                {"$unwind": "$messages"},
-                {"$match": {
-                    "user_id": user_id,
-                    "messages.role": role,
-                    "messages.created_at": {"$gte": cutoff_date}
-                }},
-                {"$group": {
-                    "_id": "$user_id",
-                    "talk_time": {"$sum": "$messages.voice_duration"}
-                }},
-                {"$limit": 1}
-            ]
-        else:
-            pipeline_total = [
-                # Match documents with the specific user_id first to optimize the pipeline
-                {
-                    "$match": {
-                        "user_id": user_id
-                    }
-                },
-                # Add a field that will hold the array of messages starting from first_message_index
-                {
-                    "$addFields": {
-                        "filtered_messages": {
-                            "$slice": [
-                                "$messages", "$first_message_index", {"$size": "$messages"}
-                            ]
-                        }
-                    }
-                },
-                # Unwind the filtered messages
-                {
-                    "$unwind": "$filtered_messages"
-                },
-                # Match to filter only messages where role is "user"
-                {
-                    "$match": {
-                        "filtered_messages.role": "user"
-                    }
-                },
-                # Group by user_id and sum the voice durations
-                {
-                    "$group": {
-                        "_id": "$user_id",
-                        "talk_time": {"$sum": "$filtered_messages.voice_duration"}
-                    }
-                }
-            ]
+            sums = await self.app.Dao.talk_time.get_sums(user_id, cutoff_date)
+            return round(sums["talk_time"].get(role, 0) / 60, 1)
+
+        user = await self.find_fields(user_id, ["first_message_index"]) or {}
+        pipeline_total = self._dialog_talk_time_pipeline(user_id, user.get("first_message_index", 0))
 
-        users_cursor = self.db[self.COLLECTION_NAME].aggregate(pipeline_total)
+        count_db_read()
+        users_cursor = self.db[self.MESSAGES_COLLECTION_NAME].aggregate(pipeline_total)
         user_result = [user async for user in users_cursor]
         user_result = user_result[0] if len(user_result) == 1 else {"talk_time": 0}
         user_talk_time_min = round(user_result["talk_time"] / 60, 1)
         return user_talk_time_min
 
+    def _dialog_talk_time_pipeline(self, user_id: int, first_message_index: int) -> list[dict]:
+        return [
+            # messages of the current dialog start from first_message_index
+            {"$match": {
+                "user_id": user_id,
+                "index": {"$gte": first_message_index},
+                "role": "user"
+            }},
+            {"$group": {
+                "_id": "$user_id",
+                "talk_time": {"$sum": "$voice_duration"}
+            }}
+        ]
+
 ######
 
 
@@ -237,20 +564,21 @@ class UserDAO(BaseDBDAO):
         elif interval == "total":
             cutoff_date = today - datetime.timedelta(days=365 * 100)
 
-        # convert date to datetime
-        pipeline_total = [
+        users_cursor = self.db[self.COLLECTION_NAME].aggregate(self._new_users_pipeline(cutoff_date))
+        user_result = [user async for user in users_cursor]
+
+        user_result = user_result[0] if len(user_result) == 1 else {"user_count": 0}
+        return user_result["user_count"]
+
+    def _new_users_pipeline(self, cutoff_date: datetime.date) -> list[dict]:
+        return [
             {"$match": {
+                # convert date to datetime
                 "subscription_start_date": {"$gte": datetime.datetime.combine(cutoff_date, datetime.time.min)}
             }},
             {"$count": "user_count"}
         ]
 
-        users_cursor = self.db[self.COLLECTION_NAME].aggregate(pipeline_total)
-        user_result = [user async for user in users_cursor]
-
-        user_result = user_result[0] if len(user_result) == 1 else {"user_count": 0}
-        return user_result["user_count"]
-
     async def get_users_speaking_duration(self, interval='day'):
 
         """
@@ -272,40 +600,37 @@ class UserDAO(BaseDBDAO):
             cutoff_date = today - datetime.timedelta(days=365 * 100)
 
         # convert date to datetime
+        cutoff = datetime.datetime.combine(cutoff_date, datetime.time.min)
         pipeline_total = [
-            {"$unwind": "$messages"},
-            {"$match": {"messages.role": "user",
-                        "messages.created_at": {"$gte": datetime.datetime.combine(cutoff_date, datetime.time.min)}}},
-            {"$group": {"_id": None,
-                        "talk_time_sum": {"$sum": "$messages.voice_duration"},
-                        "talk_time_avg": {"$avg": "$messages.voice_duration"}}},
-        ]
-
-        users_cursor = self.db[self.COLLECTION_NAME].aggregate(pipeline_total)
-        result = [user async for user in users_cursor]
-
-        result[0]["talk_time_sum"] = round(result[0]["talk_time_sum"] / 60, 2)
-        result[0]["talk_time_avg"] = round(result[0]["talk_time_avg"], 1)
-
-        # convert date to datetime
-        pipeline_total = [
-            {"$unwind": "$messages"},
-            {"$match": {"messages.role": "assistant",
-                        "messages.created_at": {
-                            "$gte": datetime.datetime.combine(cutoff_date, datetime.time.min)
-                        }}},
-            {"$group": {"_id": None,
-                        "talk_time_bot_sum": {"$sum": "$messages.voice_duration"},
-                        "talk_time_bot_avg": {"$avg": "$messages.voice_duration"}}},
+            {"$match": {"created_at": {"$gte": cutoff}}},
+            {"$project": {"role": 1, "voice_duration": 1,
+                          "voices": {"$cond": [{"$isNumber": "$voice_duration"}, 1, 0]}}},
+            # archived months: one document per role from the bucket header
+            *self._archive_union(cutoff, [
+                {"$project": {"by_role": [
+                    {"role": role, "voice_duration": f"$talk_time.{role}", "voices": f"$messages.{role}"}
+                    for role in ("user", "assistant")
+                ]}},
+                {"$unwind": "$by_role"},
+                {"$replaceRoot": {"newRoot": "$by_role"}},
+            ]),
+            {"$group": {"_id": "$role",
+                        "talk_time_sum": {"$sum": "$voice_duration"},
+                        "voices": {"$sum": "$voices"}}},
         ]
 
-        users_cursor = self.db[self.COLLECTION_NAME].aggregate(pipeline_total)
-        result2 = [user async for user in users_cursor]
+        users_cursor = self.db[self.MESSAGES_COLLECTION_NAME].aggregate(pipeline_total)
+        by_role = {r["_id"]: r async for r in users_cursor}
+        user_stats = by_role.get("user", {"talk_time_sum": 0, "voices": 0})
+        bot_stats = by_role.get("assistant", {"talk_time_sum": 0, "voices": 0})
 
-        result[0]["talk_time_bot_sum"] = round(result2[0]["talk_time_bot_sum"] / 60, 2)
-        result[0]["talk_time_bot_avg"] = round(result2[0]["talk_time_bot_avg"], 1)
-
-        return result[0]
+        return {
+            "_id": None,
+            "talk_time_sum": round(user_stats["talk_time_sum"] / 60, 2),
+            "talk_time_avg": round(user_stats["talk_time_sum"] / max(user_stats["voices"], 1), 1),
+            "talk_time_bot_sum": round(bot_stats["talk_time_sum"] / 60, 2),
+            "talk_time_bot_avg": round(bot_stats["talk_time_sum"] / max(bot_stats["voices"], 1), 1),
+        }
 
     async def get_general_bottle_days(self, interval='day', user_id=None):
 
@@ -327,21 +652,27 @@ class UserDAO(BaseDBDAO):
             cutoff_date = today - datetime.timedelta(days=365 * 100)
 
   
-        pipeline_total = []
-        pipeline_total.append({"$unwind": "$messages"})
+        cutoff = datetime.datetime.combine(cutoff_date, datetime.time.min)
+        match = {
+            "created_at": {"$gte": cutoff},
+            "role": "user"
+        }
+        if user_id is not None:
+            match["user_id"] = user_id
 
-        if user_id is None:
-            pipeline_total.append({"$match": {
-                "messages.role": "user", 
-                "messages.created_at": {"$gte": datetime.datetime.combine(cutoff_date, datetime.time.min)}}})
-        else:
-            pipeline_total.append({"$match": {
-                "user_id": user_id,
-                "messages.role": "user", 
-                "messages.created_at": {"$gte": datetime.datetime.combine(cutoff_date, datetime.time.min)}}})
+        pipeline_total = []
+        pipeline_total.append({"$match": match})
 
         pipeline_total.append({"$addFields":{
-            "day_of_year": {"$dayOfYear": "$messages.created_at"}}})
+            "day_of_year": {"$dayOfYear": "$created_at"}}})
+
+        # archived months: the days with user messages from the bucket header
+        pipeline_total.extend(self._archive_union(cutoff, [
+            *([{"$match": {"user_id": user_id}}] if user_id is not None else []),
+            {"$unwind": "$days"},
+            {"$match": {"days.messages.user": {"$gt": 0}}},
+            {"$project": {"user_id": 1, "day_of_year": {"$dayOfYear": "$days.date"}}},
+        ]))
         
         pipeline_total.append({"$group": {
                 "_id": {"user_id": "$user_id"},
@@ -351,7 +682,7 @@ class UserDAO(BaseDBDAO):
         pipeline_total.append({"$addFields": {"nuniq_days": {"$size": "$unique_days"}}})
         pipeline_total.append({"$group": {"_id": "$nuniq_days","active_users": {"$sum": 1},}})
         
-        users_cursor = self.db[self.COLLECTION_NAME].aggregate(pipeline_total)
+        users_cursor = self.db[self.MESSAGES_COLLECTION_NAME].aggregate(pipeline_total)
         result = [user async for user in users_cursor]
         result_dict = {}
         for r in result:
@@ -363,7 +694,9 @@ class UserDAO(BaseDBDAO):
         """
         interval:
             day, week, month, total - 
-        returns total time (in minutes) of user's voice messages that were sent not earlier than the start of the current <day>, <week> or <month>.
+        returns (cumulative {voices: users with at most that many voices}, median voices,
+                 number of users, {"p50", "p75", "p90", "p99"} of voices). Users without voices are excluded
+                 from the median and percentiles
         """
 
         today = datetime.date.today()
@@ -378,39 +711,22 @@ class UserDAO(BaseDBDAO):
         elif interval == "total":
             cutoff_date = today - datetime.timedelta(days=365 * 100)
 
-        # convert date to datetime 
         pipeline_total = [
-            # Filter messages to include only those where role is "user" or when array is empty
+            # Count user messages of every user who has sent at least one
+            {"$match": {"role": "user"}},
+            {"$project": {"user_id": 1}},
+            # archived months: user message counters from the bucket header
+            *self._archive_union(datetime.datetime.min, [
+                {"$match": {"messages.user": {"$gt": 0}}},
+                {"$project": {"user_id": 1, "archived_user_messages": "$messages.user"}},
+            ]),
             {
-                "$addFields": {
-                    "user_messages": {
-                        "$filter": {
-                            "input": "$messages",
-                            "as": "message",
-                            "cond": {"$eq": ["$$message.role", "user"]}
-                        }
-                    }
-                }
-            },
-            # Add the user_messages_count field which holds the number of user messages
-            {
-                "$addFields": {
-                    "user_messages_count": {"$size": "$user_messages"}
-                }
-            },
-            # Handle possible non-existent 'messages' field by setting count to 0
-            {
-                "$addFields": {
-                    "user_messages_count": {
-                        "$cond": {
-                            "if": {"$isArray": "$messages"},
-                            "then": "$user_messages_count",
-                            "else": 0
-                        }
-                    }
+                "$group": {
+                    "_id": "$user_id",
+                    "user_messages_count": {"$sum": {"$ifNull": ["$archived_user_messages", 1]}},
                 }
             },
-            # Group the documents by user_messages_count and sum the occurrences
+            # Group the users by user_messages_count and sum the occurrences
             {
                 "$group": {
                     "_id": "$user_messages_count",
@@ -419,57 +735,47 @@ class UserDAO(BaseDBDAO):
             },
         ]
 
-        users_cursor = self.db[self.COLLECTION_NAME].aggregate(pipeline_total)
+        users_cursor = self.db[self.MESSAGES_COLLECTION_NAME].aggregate(pipeline_total)
         result = [user async for user in users_cursor]
         # print('result', result[:30])
 
+        # users without any user message
+        silent_users = await self.db[self.COLLECTION_NAME].count_documents({}) - sum(r['user_count'] for r in result)
+        if silent_users > 0:
+            result.append({'_id': 0, 'user_count': silent_users})
+
         result_dict = {}
         for r in result:
             result_dict[r['_id']] = r['user_count']
         result_dict = dict(sorted(result_dict.items(), key=lambda item: item[0]))
 
-        all_vals = sum([[k]*v for k, v in result_dict.items() if k !=0], [])
-        median_voice = np.median(all_vals)
-
-        users_sum = np.sum(list(result_dict.values()))
-        # print('result_dict', result_dict)
+        values, weights = counts_to_arrays(result_dict)
+        users_sum = int(weights.sum())
+        cum_result_dict = cumulative_counts(values, weights)
 
-        cum_result_dict = result_dict.copy()
-        sorted_key = sorted(list(result_dict.keys()))  # [::-1]
-        # print('sorted_key', sorted_key)        
+        nonzero = values != 0
+        percentiles = weighted_percentiles(values[nonzero], weights[nonzero])
+        median_voice = percentiles["p50"]
 
-        cum_result_dict[-1] = 0
-        for i, voice_num in enumerate(sorted(sorted_key)):
-            cum_result_dict[voice_num] += cum_result_dict[sorted_key[i - 1]]
-        del cum_result_dict[-1]
-
-        # print('cum_result_dict', cum_result_dict)      
-
-        return cum_result_dict, median_voice, users_sum
+        return cum_result_dict, median_voice, users_sum, percentiles
 
     async def get_users_top(self, user_telegram_id: int, top_n=10):
-        today = datetime.date.today()
-        last_monday = today - datetime.timedelta(days=today.weekday())
-        # convert date to datetime
-        last_monday = datetime.datetime.combine(last_monday, datetime.time.min)
-        pipeline_total = [
-            {"$unwind": "$messages"},
-            {"$match": {
-                "messages.role": "user",
-                "messages.created_at": {"$gte": last_monday}
-            }},
-            {"$group": {
-                "_id": "$user_id",
-                "talk_time": {"$sum": "$messages.voice_duration"},
-                "username": {"$first": "$username"}
-            }},
-            {"$sort": {"talk_time": -1}}
-        ]
-
-        users_cursor = self.db[self.COLLECTION_NAME].aggregate(pipeline_total)
-        users_sorted = [user async for user in users_cursor]
-
-        users_top = users_sorted[:top_n]
+        """
+        returns top_n users of the current week, position and talk time (in minutes) of the user.
+        Served from the in-memory leaderboard, only the usernames of the top are read from db
+        """
+        leaderboard = self.app.Managers.leaderboard
+        users_top = [{"_id": user_id, "talk_time": seconds} for user_id, seconds in leaderboard.top(top_n)]
+
+        count_db_read()
+        usernames = {
+            user["user_id"]: user.get("username", "Unknown")
+            async for user in self.db[self.COLLECTION_NAME].find(
+                {"user_id": {"$in": [user["_id"] for user in users_top]}}, {"_id": 0, "user_id": 1, "username": 1}
+            )
+        }
+        for user in users_top:
+            user["username"] = usernames.get(user["_id"], "Unknown")
 
         users_top_formatted = []
         for user in users_top:
@@ -478,20 +784,11 @@ class UserDAO(BaseDBDAO):
                 'name': user.get('username', 'Unknown'),
                 'talk_time': round(user.get('talk_time', 0) / 60, 1)
             })
-        user_position = next(
-            (index + 1 for index, user in enumerate(users_sorted) if user["_id"] == user_telegram_id), len(users_sorted)
-        )
-        
-        user_talk_time_sec = next((u for u in users_sorted if u["_id"] == user_telegram_id), {"talk_time": 0})["talk_time"]
+        user_position, user_talk_time_sec = leaderboard.rank(user_telegram_id)
         user_talk_time_min = round(user_talk_time_sec / 60, 1)
 
         return users_top_formatted, user_position, user_talk_time_min
 
-    async def create_random_users(self, count=2000):
-        for _ in range(count):
-            user_data = generate_random_user()
-            await self.create(user_data.__dict__)
-
     async def get_avg_voice_messages_count(self, user_id: int, interval: str):
         today = datetime.date.today()
         if interval == "day":
@@ -504,45 +801,51 @@ class UserDAO(BaseDBDAO):
             raise ValueError("interval must be 'day', 'week', 'month'")
         # convert date to datetime
         cutoff_date = datetime.datetime.combine(cutoff_date, datetime.time.min)
-        pipeline = [
-            {"$unwind": "$messages"},
-            {"$match": {
-                "user_id": user_id,
-                "messages.role": "user",
-                "messages.created_at": {"$gte": cutoff_date}
-            }},
-            {"$group": {
-                "_id": "$user_id",
-                "voice_count": {"$sum": 1}
-            }},
-            {"$limit": 1}
-        ]
+        sums = await self.app.Dao.talk_time.get_sums(user_id, cutoff_date)
+        return sums["messages"]["user"]
+
+
+def truncate_datetime(dt: datetime.datetime, granularity: str) -> datetime.datetime:
+    if granularity == "hour":
+        return dt.replace(minute=0, second=0, microsecond=0)
+    day = datetime.datetime.combine(dt.date(), datetime.time.min)
+    if granularity == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    return day
+
+
+def server_timezone() -> str:
+    """zone of the naive created_at values: TZ of the container, the current utc offset of the host otherwise"""
+    return os.environ.get("TZ") or datetime.datetime.now().astimezone().strftime("%z")
+
+
+def parse_timezone(timezone: str) -> datetime.tzinfo:
+    """Olson name or utc offset ("Europe/Moscow", "+03:00", "+0300", "+03"), as $dateToString accepts them"""
+    offset = re.fullmatch(r"([+-])(\d{2}):?(\d{2})?", timezone)
+    if offset is None:
+        return zoneinfo.ZoneInfo(timezone)
+    sign = -1 if offset.group(1) == "-" else 1
+    return datetime.timezone(sign * datetime.timedelta(hours=int(offset.group(2)), minutes=int(offset.group(3) or 0)))
+
+
+def to_wall_time(dt: datetime.datetime, tz: datetime.tzinfo) -> datetime.datetime:
+    """naive wall time of tz, naive datetimes are taken as wall times of tz already"""
+    return dt if dt.tzinfo is None else dt.astimezone(tz).replace(tzinfo=None)
+
 
+def server_local_to_instant(field: str) -> dict:
+    """
+    aggregation expression of the instant of a naive server local datetime: mongo reads naive values as utc,
+    the wall time parts are read back in the server timezone
+    """
+    parts = {"year": "$year", "month": "$month", "day": "$dayOfMonth", "hour": "$hour", "minute": "$minute",
+             "second": "$second", "millisecond": "$millisecond"}
+    return {"$dateFromParts": {**{part: {operator: field} for part, operator in parts.items()},
+                               "timezone": server_timezone()}}
 
 
-def generate_random_user():
-    user = UserData(
-        user_id=random.randint(1, 100000),
-        username=''.join(random.choices(string.ascii_letters, k=10)),
-        subscription=random.choice(['free', 'premium']),
-        email=None if random.choice([True, False]) else ''.join(
-            random.choices(string.ascii_letters + string.digits, k=10)) + "@example.com",
-        subscription_start_date=datetime.datetime.utcnow() - datetime.timedelta(days=random.randint(0, 365)),
-        generations=random.randint(0, 100),
-        today_generations=random.randint(0, 100),
-        last_generation_date=datetime.datetime.utcnow() - datetime.timedelta(days=random.randint(0, 365)),
-        messages=[{
-            "role": random.choice(["user", "assistant"]),
-            "content": ''.join(
-                random.choices(string.ascii_letters + string.digits + string.punctuation, k=random.randint(10, 100))),
-            "voice_file_id": str(uuid.uuid4()),
-            "voice_duration": random.uniform(0.0, 60.0),
-            "created_at": datetime.datetime.utcnow() - datetime.timedelta(days=random.randint(0, 365))
-        } for _ in range(random.randint(0, 100))],
-        payments_data={"payment_id": None},
-        preferences={"sub_autoextend": random.choice([True, False])},
-        bot_state="default",
-        temp_data={}
-    )
-
-    return user
+def pop_internal_fields(data: dict) -> dict:
+    """removes fields that find_by_user_id never returns"""
+    data.pop("_id", None)
+    data.pop("messages", None)
+    return data
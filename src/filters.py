@@ -3,7 +3,6 @@ from telebot.asyncio_filters import AdvancedCustomFilter
 from telebot.types import Message
 
 from models.app import App
-from utils.structures import UserData
 
 
 class KnownUser(asyncio_filters.SimpleCustomFilter):
@@ -11,7 +10,7 @@ class KnownUser(asyncio_filters.SimpleCustomFilter):
 
     @staticmethod
     async def check(message: Message):
-        return message.from_user.id in App()["known_users"]
+        return await App().Dao.user.is_known(message.from_user.id)
 
 
 class Admin(asyncio_filters.SimpleCustomFilter):
@@ -26,9 +25,8 @@ class CheckMessagesCountMore(AdvancedCustomFilter):
     key = 'messages_count'
 
     async def check(self, message, text):
-        data = await App().Dao.user.find_by_user_id(message.from_user.id)
-        user = UserData(**data)
-        return len(user.messages) > int(text)
+        messages_count = await App().Dao.user.get_messages_count(message.from_user.id)
+        return messages_count > int(text)
 
 
 class CheckBotState(AdvancedCustomFilter):
@@ -37,6 +35,5 @@ class CheckBotState(AdvancedCustomFilter):
     async def check(self, message, allowed_states):
         if isinstance(allowed_states, str):
             allowed_states = [allowed_states]
-        data = await App().Dao.user.find_by_user_id(message.from_user.id)
-        user = UserData(**data)
-        return user.bot_state in allowed_states
+        data = await App().Dao.user.find_fields(message.from_user.id, ["bot_state"]) or {}
+        return data.get("bot_state", "default") in allowed_states
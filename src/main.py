@@ -19,8 +19,14 @@ import utils
 from dao import setup_dao
 from filters import KnownUser, Admin
 from managers import setup_managers
+from middlewares import UpdateContextMiddleware
 from models.app import App
+from routes.english_tips import phrase2start
+from routes.texts import get_opener_text
 from settings import get_config
+from utils import tokens
+from utils.analytics import stats_snapshot_loop
+from utils.gpt import warm_up_tts
 from utils.structures import UserData
 
 # from migrations.mongo_migrate import migrate_users
@@ -74,6 +80,9 @@ async def main(argv):
 
     await setup_managers(app)
     await setup_dao(app)
+    await app.Dao.stats.check_claim_index()
+    await app.Managers.leaderboard.rebuild(app.Dao.talk_time)
+    tokens.preload()
     # await setup_tasks(app)
     
     # mongo migrations
@@ -81,7 +90,6 @@ async def main(argv):
     # mongo migrations
     #await migrate_users()
 
-    app["known_users"] = await app.Dao.user.find_known_users_ids()
     logging.basicConfig(
         level=logging.getLevelName(config["logging_level"]),
         format='%(asctime)s (%(filename)s:%(lineno)d %(threadName)s) %(levelname)s - %(name)s: "%(message)s"',
@@ -135,6 +143,9 @@ async def main(argv):
         logging.info(webhook_url)
         await bot.set_webhook(url=webhook_url)
 
+    app["update_context_middleware"] = UpdateContextMiddleware()
+    bot.setup_middleware(app["update_context_middleware"])
+
     bot.add_custom_filter(asyncio_filters.StateFilter(bot))
     bot.add_custom_filter(KnownUser())
     bot.add_custom_filter(Admin())
@@ -151,6 +162,12 @@ async def main(argv):
         bot.register_message_handler(routes.rating.get_rating, commands=['rating'], pass_bot=True)
         bot.register_message_handler(routes.avatar.send_help, commands=["help"], pass_bot=True)
 
+        ################ admin ################
+
+        bot.register_message_handler(routes.admin.get_stats, commands=["stats"], admin=True, pass_bot=True)
+        bot.register_message_handler(routes.admin.refresh_stats, commands=["stats_refresh"], admin=True, pass_bot=True)
+        bot.register_message_handler(routes.admin.get_db_stats, commands=["dbstats"], admin=True, pass_bot=True)
+
         ######## conversation keyboard ########
 
         bot.register_message_handler(
@@ -211,6 +228,25 @@ async def main(argv):
 
     register_handlers()
 
+    async def leaderboard_rebuild_loop():
+        # picks up turns stored by other bot processes
+        while True:
+            await asyncio.sleep(config.get("leaderboard", {}).get("rebuild_interval", 3600))
+            await app.Managers.leaderboard.rebuild(app.Dao.talk_time)
+
+    async def tts_warmup():
+        # the opener voices of /start are sent from the TTS cache, new or changed phrases are synthesized here
+        warmup_config = config.get("tts", {}).get("warmup", {})
+        if not warmup_config.get("enabled", True):
+            return
+        texts = [get_opener_text(question) for question in phrase2start]
+        synthesized = await warm_up_tts(texts, concurrency=warmup_config.get("concurrency", 4))
+        logging.info(f"TTS warmup: {synthesized} of {len(texts)} openers synthesized")
+
+    asyncio.create_task(leaderboard_rebuild_loop())
+    asyncio.create_task(tts_warmup())
+    asyncio.create_task(stats_snapshot_loop(app))
+
     # async def autoextend_loop(bot: AsyncTeleBot):
     #     while True:
     #         await routes.payments.sub_autoextend_all(bot)
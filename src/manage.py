@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+
+from dao import setup_dao
+from dao.indexes import explain_all, reconcile_all
+from managers import setup_managers
+from models.app import App
+from settings import get_config
+from utils.analytics import refresh_stats_snapshots
+from utils import tokens
+from utils.seed import DEFAULT_START_USER_ID, drop_seeded_users, seed_users
+
+
+async def migrate_messages(app: App, args):
+    migrated = await app.Dao.user.migrate_embedded_messages()
+    logging.info(f"Moved embedded history of {migrated} users to the messages collection")
+
+
+async def backfill_rollups(app: App, args):
+    await app.Dao.talk_time.rebuild(args.user_id)
+    logging.info("Talk time rollups rebuilt")
+
+
+async def refresh_stats(app: App, args):
+    await refresh_stats_snapshots(app)
+
+
+async def indexes(app: App, args):
+    reports = await reconcile_all(app, create=not args.dry_run, fix_conflicts=args.fix_conflicts,
+                                  drop_extra=args.drop_extra)
+    for report in reports:
+        report.log()
+        logging.info(f"{report.collection}: ok {report.ok}, extra {report.extra}, unused {report.unused}")
+
+    if args.explain:
+        for query, plan in (await explain_all(app)).items():
+            if "error" in plan:
+                logging.error(f"{query}: {plan['error']}")
+            elif plan["collscan"]:
+                logging.warning(f"{query}: COLLSCAN {plan['stages']}")
+            else:
+                logging.info(f"{query}: {plan['indexes']} {plan['stages']}")
+
+
+async def archive(app: App, args):
+    totals = await app.Dao.user.archive_old_messages(args.max_age_days)
+    logging.info(f"Archived {totals['messages']} messages of {totals['users']} users")
+    logging.info(f"Archive: {await app.Dao.message_archive.stats()}")
+
+
+async def export(app: App, args):
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        async for msg in app.Dao.message_archive.iter_history(args.user_id):
+            output.write(json.dumps(msg, ensure_ascii=False, default=str) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+async def seed(app: App, args):
+    if args.drop:
+        await drop_seeded_users(app, args.start_user_id)
+    totals = await seed_users(app, args.users, seed=args.seed, start_user_id=args.start_user_id,
+                              batch_size=args.batch_size)
+    logging.info(f"Seeded {totals}")
+
+
+async def tiktoken(app: App, args):
+    # downloads the BPE file into TIKTOKEN_CACHE_DIR if it is not there, commit it, the bot never downloads it
+    logging.info(f"tiktoken {tokens.ENCODING_NAME}: {tokens.download()}")
+
+
+COMMANDS = {
+    "migrate-messages": migrate_messages,
+    "backfill-rollups": backfill_rollups,
+    "refresh-stats": refresh_stats,
+    "indexes": indexes,
+    "seed": seed,
+    "archive": archive,
+    "export": export,
+    "tiktoken": tiktoken,
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Maintenance commands")
+    parser.add_argument(
+        "--config",
+        dest="config",
+        required=False,
+        type=str,
+        default=os.environ.get("APP_CONFIG", "config.yaml"),
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate-messages", help="move embedded user.messages arrays to the messages collection")
+    backfill_parser = subparsers.add_parser("backfill-rollups", help="rebuild daily talk time rollups from messages")
+    backfill_parser.add_argument("--user-id", type=int, default=None, help="rebuild only this user")
+    subparsers.add_parser("refresh-stats", help="recompute admin analytics snapshots")
+    indexes_parser = subparsers.add_parser("indexes", help="create declared indexes, report missing/extra/unused ones")
+    indexes_parser.add_argument("--dry-run", action="store_true", help="only report missing indexes")
+    indexes_parser.add_argument("--fix-conflicts", action="store_true",
+                                help="recreate indexes whose options differ from the declaration")
+    indexes_parser.add_argument("--drop-extra", action="store_true", help="drop indexes that are not declared")
+    indexes_parser.add_argument("--explain", action="store_true", help="check query plans of the DAO queries")
+    seed_parser = subparsers.add_parser("seed", help="insert synthetic users and messages for load tests")
+    seed_parser.add_argument("--users", type=int, default=10000)
+    seed_parser.add_argument("--seed", type=int, default=0, help="same seed gives the same data")
+    seed_parser.add_argument("--start-user-id", type=int, default=DEFAULT_START_USER_ID)
+    seed_parser.add_argument("--batch-size", type=int, default=10000, help="users generated and inserted at once")
+    seed_parser.add_argument("--drop", action="store_true", help="delete previously seeded users first")
+    archive_parser = subparsers.add_parser("archive", help="move old finished dialogs to compressed month buckets")
+    archive_parser.add_argument("--max-age-days", type=int, default=None, help="default: archive.max_age_days")
+    export_parser = subparsers.add_parser("export", help="write the whole history of a user as json lines")
+    export_parser.add_argument("--user-id", type=int, required=True)
+    export_parser.add_argument("--output", type=str, default=None, help="file, stdout by default")
+    subparsers.add_parser("tiktoken", help="download the cl100k_base tokenizer into assets/tiktoken")
+    return parser
+
+
+async def main(argv):
+    args = get_parser().parse_args(argv)
+
+    app = App()
+    config = get_config(argv)
+    app["config"] = config
+    logging.basicConfig(level=logging.getLevelName(config["logging_level"]))
+
+    await setup_managers(app)
+    await setup_dao(app)
+    try:
+        await COMMANDS[args.command](app, args)
+    finally:
+        await app.Managers.db_manager.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -1,18 +1,28 @@
 from dataclasses import dataclass
 
+from managers.audio import AudioManager
 from managers.database import DatabaseManager
+from managers.leaderboard import LeaderboardManager
 from managers.session import SessionManager
+from managers.tts_cache import TTSCacheManager
 
 
 @dataclass
 class Managers:
     db_manager: DatabaseManager
     session_manager: SessionManager
+    leaderboard: LeaderboardManager
+    audio: AudioManager
+    tts_cache: TTSCacheManager
 
 
 async def setup_managers(app):
     app.Managers = Managers(
         db_manager=DatabaseManager(app["config"]),
-        session_manager=SessionManager(app["config"])
+        session_manager=SessionManager(app["config"]),
+        leaderboard=LeaderboardManager(app["config"]),
+        audio=AudioManager(app["config"]),
+        tts_cache=TTSCacheManager(app["config"]),
     )
+    app.Managers.tts_cache.load()
     await app.Managers.db_manager.connect()
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from utils import audio
+from utils.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class AudioManager:
+    """
+    Runs ffmpeg based decoding/encoding (pydub) in a process pool, off the event loop.
+    At most audio.max_concurrency jobs are submitted at once, the rest wait in the queue
+    """
+
+    def __init__(self, config) -> None:
+        self.config = config
+        audio_config = config.get("audio", {})
+        self.workers = audio_config.get("workers", 2)
+        self.semaphore = asyncio.Semaphore(audio_config.get("max_concurrency", self.workers * 2))
+        self.queue_warning = audio_config.get("queue_warning", 20)
+        self.executor: ProcessPoolExecutor | None = None
+
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queued = 0
+        self.errors = 0
+        self.wait_ms = Histogram()
+        self.run_ms = Histogram()
+
+    def start(self) -> None:
+        # forkserver: workers don't inherit the threads and sockets of the bot process
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context("forkserver"))
+
+    def stop(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func, *args, **kwargs):
+        if self.executor is None:
+            self.start()
+
+        queued_at = time.perf_counter()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        if self.queued > self.queue_warning:
+            logger.warning(f"Audio queue depth {self.queued}, {self.in_flight} jobs running")
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        started_at = time.perf_counter()
+        self.wait_ms.observe((started_at - queued_at) * 1000)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.run_ms.observe((time.perf_counter() - started_at) * 1000)
+            self.semaphore.release()
+
+    async def duration(self, data: bytes, audio_format: str) -> float:
+        """duration in seconds, decodes the whole file"""
+        return await self.run(audio.decode_duration, data, audio_format)
+
+    async def transcode(self, data: bytes, src_format: str, dst_format: str, codec: str | None = None,
+                        bitrate: str | None = None, parameters: list[str] | None = None) -> tuple[bytes, float]:
+        """returns (encoded bytes, duration in seconds)"""
+        return await self.run(audio.transcode, data, src_format, dst_format, codec=codec, bitrate=bitrate,
+                              parameters=parameters)
+
+    async def concat(self, segments: list[bytes], src_format: str, dst_format: str, codec: str | None = None,
+                     bitrate: str | None = None, parameters: list[str] | None = None) -> tuple[bytes, float]:
+        """returns (one file of all segments, total duration in seconds)"""
+        return await self.run(audio.concat, segments, src_format, dst_format, codec=codec, bitrate=bitrate,
+                              parameters=parameters)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "max_queued": self.max_queued,
+            "errors": self.errors,
+            "wait_ms": self.wait_ms.snapshot(),
+            "run_ms": self.run_ms.snapshot(),
+        }
@@ -3,6 +3,8 @@ from typing import Optional
 
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from managers.mongo_monitoring import CommandMetricsListener
+
 logger = logging.getLogger(__name__)
 
 
@@ -11,9 +13,27 @@ class DatabaseManager:
         self.config = config
         self.client: Optional[AsyncIOMotorClient] = None
 
+        monitoring_config = config["mongodb"].get("monitoring", {})
+        self.command_listener = CommandMetricsListener(
+            slow_query_ms=monitoring_config.get("slow_query_ms", 100),
+            reply_sizes=monitoring_config.get("reply_sizes", False),
+            reply_size_every=monitoring_config.get("reply_size_every", 100),
+        )
+
+    def client_options(self) -> dict:
+        pool_config = self.config["mongodb"].get("pool", {})
+        options = {
+            "maxPoolSize": pool_config.get("max_pool_size", 100),
+            "minPoolSize": pool_config.get("min_pool_size", 0),
+            "event_listeners": [self.command_listener],
+        }
+        if pool_config.get("compressors"):
+            options["compressors"] = ",".join(pool_config["compressors"])
+        return options
+
     async def connect(self):
         if self.config["mongodb"].get("connection_string"):
-            self.client = AsyncIOMotorClient(self.config["mongodb"]["connection_string"])
+            self.client = AsyncIOMotorClient(self.config["mongodb"]["connection_string"], **self.client_options())
         else:
             self.client = AsyncIOMotorClient(
                 host=self.config["mongodb"]["host"],
@@ -21,6 +41,7 @@ class DatabaseManager:
                 username=self.config["mongodb"]["user"],
                 password=self.config["mongodb"]["password"],
                 authSource="admin",
+                **self.client_options(),
             )
         await self.client.admin.command({"ping": 1})
         logger.info("Database connected")
@@ -0,0 +1,90 @@
+import datetime
+import logging
+
+from sortedcontainers import SortedList
+
+logger = logging.getLogger(__name__)
+
+
+def current_week_start() -> datetime.datetime:
+    today = datetime.date.today()
+    return datetime.datetime.combine(today - datetime.timedelta(days=today.weekday()), datetime.time.min)
+
+
+class LeaderboardManager:
+    """
+    Weekly talk time leaderboard kept in memory.
+    Scores are user talk seconds since Monday. Top-N and rank queries are O(log n)
+    """
+
+    def __init__(self, config) -> None:
+        self.config = config
+        self.week_start = current_week_start()
+        self.scores: dict[int, float] = {}
+        self.ranking = SortedList()  # (-score, user_id)
+        # turns added while rebuild() reads the totals, applied on top of them: [(user_id, seconds, created_at)]
+        self._pending: list[tuple[int, float, datetime.datetime | None]] | None = None
+
+    def __len__(self):
+        self._rollover()
+        return len(self.scores)
+
+    def _rollover(self) -> None:
+        week_start = current_week_start()
+        if week_start != self.week_start:
+            logger.info(f"Leaderboard rollover to the week of {week_start.date()}")
+            self.week_start = week_start
+            self.scores.clear()
+            self.ranking.clear()
+
+    def _set(self, user_id: int, score: float) -> None:
+        old_score = self.scores.get(user_id)
+        if old_score is not None:
+            self.ranking.remove((-old_score, user_id))
+        self.scores[user_id] = score
+        self.ranking.add((-score, user_id))
+
+    def add(self, user_id: int, seconds: float, created_at: datetime.datetime | None = None) -> None:
+        """adds talk time of a stored turn, turns of the previous weeks are ignored"""
+        self._rollover()
+        if self._pending is not None:
+            self._pending.append((user_id, seconds, created_at))
+        if created_at is not None and created_at < self.week_start:
+            return
+        self._set(user_id, self.scores.get(user_id, 0) + seconds)
+
+    def top(self, n: int = 10) -> list[tuple[int, float]]:
+        """returns [(user_id, seconds), ...] sorted by talk time"""
+        self._rollover()
+        return [(user_id, -neg_score) for neg_score, user_id in self.ranking.islice(0, n)]
+
+    def rank(self, user_id: int) -> tuple[int, float]:
+        """
+        returns (position, seconds). Position is 1-based,
+        users without talk time this week get the position after the last one
+        """
+        self._rollover()
+        score = self.scores.get(user_id)
+        if score is None:
+            return len(self.ranking) + 1, 0
+        return self.ranking.index((-score, user_id)) + 1, score
+
+    async def rebuild(self, talk_time_dao) -> None:
+        """
+        loads this week's totals from the daily rollups. Turns added while the totals are read are applied
+        after the swap, a turn whose rollup the query already saw may be counted twice until the next rebuild
+        """
+        week_start = current_week_start()
+        self._pending = []
+        try:
+            totals = await talk_time_dao.get_totals_since(week_start)
+        finally:
+            pending, self._pending = self._pending, None
+        self.week_start = week_start
+        self.scores = {}
+        self.ranking = SortedList()
+        for user_id, seconds in totals.items():
+            self._set(user_id, seconds)
+        for user_id, seconds, created_at in pending:
+            self.add(user_id, seconds, created_at)
+        logger.info(f"Leaderboard rebuilt with {len(self.scores)} users")
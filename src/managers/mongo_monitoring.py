@@ -0,0 +1,120 @@
+import itertools
+import logging
+import threading
+from collections import defaultdict
+
+import bson
+from pymongo import monitoring
+
+from utils.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# reply sizes in bytes
+REPLY_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, float("inf"))
+# fields of a command that don't describe the query
+SERVICE_FIELDS = {"$db", "lsid", "$clusterTime", "txnNumber", "$readPreference", "readConcern", "writeConcern",
+                  "autocommit", "startTransaction", "comment", "apiVersion", "cursor"}
+
+
+def query_shape(value, depth: int = 0):
+    """the command with values replaced by "?", keeps field names and operators, e.g. {"user_id": "?"}"""
+    if depth > 8:
+        return "..."
+    if isinstance(value, dict):
+        return {key: query_shape(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, list):
+        if all(not isinstance(item, (dict, list)) for item in value):
+            return f"[{len(value)} values]" if value else []
+        return [query_shape(item, depth + 1) for item in value]
+    if isinstance(value, str) and value.startswith("$"):
+        # field path of an aggregation expression, not user data
+        return value
+    return "?"
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """
+    Per command, per collection latency and reply size histograms, error counts and the slow query log.
+    pymongo calls listeners from the motor executor threads, so updates are done under a lock.
+    Reply sizes cost a re-encoding of the reply: off by default, measured for every reply_size_every-th reply,
+    getMore batches are skipped
+    """
+
+    def __init__(self, slow_query_ms: float = 100, reply_sizes: bool = False, reply_size_every: int = 100) -> None:
+        self.slow_query_ms = slow_query_ms
+        self.reply_sizes = reply_sizes
+        self.reply_size_every = max(1, reply_size_every)
+        self._replies = itertools.count(1)
+        self.lock = threading.Lock()
+        # (request_id, connection_id) -> (collection, command)
+        self.pending: dict[tuple, tuple[str, dict]] = {}
+        self.latency: dict[tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.reply_size: dict[tuple[str, str], Histogram] = defaultdict(lambda: Histogram(REPLY_SIZE_BUCKETS))
+        self.errors: dict[tuple[str, str], int] = defaultdict(int)
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        target = event.command.get(event.command_name)
+        # getMore carries the cursor id under its name and the collection separately
+        collection = event.command.get("collection") if event.command_name == "getMore" else target
+        collection = collection if isinstance(collection, str) else event.database_name
+        with self.lock:
+            self.pending[(event.request_id, event.connection_id)] = (collection, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        size = None
+        if (self.reply_sizes and event.command_name != "getMore"
+                and next(self._replies) % self.reply_size_every == 0):
+            size = len(bson.encode(event.reply))
+        self._finish(event, size=size)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, failure=event.failure)
+
+    def _finish(self, event, size: int | None = None, failure: dict | None = None) -> None:
+        duration_ms = event.duration_micros / 1000
+        with self.lock:
+            collection, command = self.pending.pop((event.request_id, event.connection_id), ("?", {}))
+            key = (event.command_name, collection)
+            self.latency[key].observe(duration_ms)
+            if size is not None:
+                self.reply_size[key].observe(size)
+            if failure is not None:
+                self.errors[key] += 1
+
+        if failure is not None:
+            logger.warning(f"Mongo {event.command_name} {collection} failed in {duration_ms:.1f}ms: "
+                           f"{failure.get('errmsg', failure)}")
+        elif duration_ms >= self.slow_query_ms:
+            logger.warning(f"Slow mongo {event.command_name} {collection} {duration_ms:.1f}ms: "
+                           f"{self._describe(event.command_name, command)}")
+
+    def _describe(self, command_name: str, command: dict) -> dict:
+        shape = {}
+        for key, value in command.items():
+            if key in SERVICE_FIELDS or key == command_name:
+                continue
+            if key == "documents":
+                shape[key] = f"[{len(value)} documents]"
+            else:
+                shape[key] = query_shape(value)
+        return shape
+
+    def stats(self) -> dict:
+        """{"<command> <collection>": {"latency_ms": {...}, "reply_bytes": {...}, "errors": n}}"""
+        with self.lock:
+            return {
+                f"{command} {collection}": {
+                    "latency_ms": histogram.snapshot(),
+                    "reply_bytes": self.reply_size[(command, collection)].snapshot()
+                    if (command, collection) in self.reply_size else None,
+                    "errors": self.errors.get((command, collection), 0),
+                }
+                for (command, collection), histogram in self.latency.items()
+            }
+
+    def reset(self) -> None:
+        with self.lock:
+            self.latency.clear()
+            self.reply_size.clear()
+            self.errors.clear()
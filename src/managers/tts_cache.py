@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+
+
+class TTSCacheManager:
+    """
+    Content-addressed cache of synthesized voices on local disk.
+    key = sha256(text, voice, model, format), entry = {"size", "duration", "file_id", "last_used", "pinned"},
+    audio in <key>.ogg. The least recently used entries are evicted when the files take more than tts.cache.max_bytes,
+    pinned ones (pre-rendered openers) are kept.
+    The index is rewritten atomically (tmp file + os.replace) at most once per tts.cache.index_save_delay seconds,
+    so it survives restarts; voices written after the last save are removed as orphans on load
+    """
+
+    def __init__(self, config) -> None:
+        self.config = config
+        cache_config = config.get("tts", {}).get("cache", {})
+        self.enabled = cache_config.get("enabled", True)
+        self.directory = cache_config.get("dir", "/src/assets/tts_cache")
+        self.max_bytes = cache_config.get("max_bytes", 200 * 1024 * 1024)
+        # long answers are unique, caching them only evicts the short recurring ones
+        self.max_text_length = cache_config.get("max_text_length", 300)
+        self.index_save_delay = cache_config.get("index_save_delay", 5)
+
+        self.entries: OrderedDict[str, dict] = OrderedDict()  # least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = asyncio.Lock()
+        self._save_task: asyncio.Task | None = None
+
+    @staticmethod
+    def key(text: str, voice: str, model: str, audio_format: str) -> str:
+        return hashlib.sha256(json.dumps([text, voice, model, audio_format]).encode()).hexdigest()
+
+    def cacheable(self, text: str) -> bool:
+        return self.enabled and len(text) <= self.max_text_length
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.ogg")
+
+    def load(self) -> None:
+        """reads the index, drops entries without audio files"""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE)) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = {}
+        except ValueError:
+            logger.warning("TTS cache index is corrupted, starting with an empty cache")
+            entries = {}
+
+        self.entries.clear()
+        for key, entry in sorted(entries.items(), key=lambda item: item[1].get("last_used", 0)):
+            if os.path.exists(self._path(key)):
+                self.entries[key] = entry
+        for file_name in os.listdir(self.directory):
+            key, extension = os.path.splitext(file_name)
+            if extension == ".ogg" and key not in self.entries:
+                _remove_file(os.path.join(self.directory, file_name))
+        self.total_bytes = sum(entry["size"] for entry in self.entries.values())
+        logger.info(f"TTS cache: {len(self.entries)} voices, {self.total_bytes / 1024 / 1024:.1f} MB")
+
+    def _schedule_save(self) -> None:
+        """the changes of the next index_save_delay seconds are written by one save"""
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_index_later())
+
+    async def _save_index_later(self) -> None:
+        await asyncio.sleep(self.index_save_delay)
+        try:
+            await self._save_index()
+        except Exception as e:
+            logger.error(f"TTS cache index is not saved: {e}")
+
+    async def _save_index(self) -> None:
+        # the snapshot is taken on the event loop, get() reorders the entries meanwhile, serialized in the thread
+        index = {key: dict(entry) for key, entry in self.entries.items()}
+        await asyncio.to_thread(_write_index, os.path.join(self.directory, INDEX_FILE), index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def get(self, key: str) -> dict | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry["last_used"] = time.time()
+        self.entries.move_to_end(key)
+        return entry
+
+    async def read(self, key: str) -> bytes | None:
+        try:
+            return await asyncio.to_thread(_read_file, self._path(key))
+        except FileNotFoundError:
+            async with self.lock:
+                self._drop(key)
+            self._schedule_save()
+            return None
+
+    async def put(self, key: str, audio: bytes, duration: float, file_id: str | None = None,
+                  pinned: bool = False) -> None:
+        if len(audio) > self.max_bytes:
+            return
+        async with self.lock:
+            await asyncio.to_thread(_write_file, self._path(key), audio)
+            self._drop(key)
+            self.entries[key] = {"size": len(audio), "duration": duration, "file_id": file_id,
+                                 "last_used": time.time(), "pinned": pinned}
+            self.total_bytes += len(audio)
+            evicted = self._evict()
+        self._schedule_save()
+        for path in evicted:
+            await asyncio.to_thread(_remove_file, path)
+
+    def set_file_id(self, key: str, file_id: str | None) -> None:
+        entry = self.entries.get(key)
+        if entry is None or entry["file_id"] == file_id:
+            return
+        entry["file_id"] = file_id
+        self._schedule_save()
+
+    def set_pinned(self, keys: set[str]) -> None:
+        """pinned entries are never evicted, the previously pinned ones not in keys become regular entries"""
+        for key, entry in self.entries.items():
+            entry["pinned"] = key in keys
+        self._schedule_save()
+
+    def _drop(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry["size"]
+
+    def _evict(self) -> list[str]:
+        """removes the least recently used not pinned entries from the index, returns their files"""
+        evicted = []
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if not self.entries[key].get("pinned"):
+                self.total_bytes -= self.entries.pop(key)["size"]
+                evicted.append(self._path(key))
+        return evicted
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _write_index(path: str, index: dict) -> None:
+    _write_file(path, json.dumps(index).encode())
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,47 @@
+import logging
+
+from telebot.asyncio_handler_backends import BaseMiddleware
+from telebot.types import CallbackQuery, Message
+
+from models.app import App
+from models.update_context import get_update_context, start_update_context, finish_update_context
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    """
+    Opens UpdateContext for every message/callback update and reports how many db reads the update cost
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+        self.updates = 0
+        self.db_reads = 0
+        self.max_db_reads = 0
+
+    async def pre_process(self, message: Message | CallbackQuery, data: dict):
+        data["update_context_token"] = start_update_context(message.from_user.id)
+
+    async def post_process(self, message: Message | CallbackQuery, data: dict, exception):
+        context = get_update_context()
+        self.updates += 1
+        self.db_reads += context.db_reads
+        self.max_db_reads = max(self.max_db_reads, context.db_reads)
+
+        reads_limit = App()["config"]["bot"].get("db_reads_per_update_warning", 5)
+        if context.db_reads > reads_limit:
+            logger.warning(f"Update from {context.user_id} cost {context.db_reads} db reads")
+        else:
+            logger.debug(f"Update from {context.user_id} cost {context.db_reads} db reads")
+
+        finish_update_context(data["update_context_token"])
+
+    def stats(self) -> dict:
+        return {
+            "updates": self.updates,
+            "db_reads": self.db_reads,
+            "avg_db_reads": round(self.db_reads / self.updates, 2) if self.updates else 0,
+            "max_db_reads": self.max_db_reads,
+        }
@@ -0,0 +1,37 @@
+from contextvars import ContextVar
+
+
+class UpdateContext:
+    """
+    Storage living for the duration of one telegram update.
+    Filters, routes and utils share the user documents loaded in it, so each user is read once per update.
+    """
+
+    def __init__(self, user_id: int | None = None):
+        self.user_id = user_id
+        self.users: dict[int, dict | None] = {}
+        # fields of user documents loaded with projections, see UserDAO.find_fields
+        self.partial_users: dict[int, dict] = {}
+        self.db_reads = 0
+
+
+_current_update: ContextVar[UpdateContext | None] = ContextVar("current_update", default=None)
+
+
+def get_update_context() -> UpdateContext | None:
+    """returns context of the update being processed or None outside of update processing"""
+    return _current_update.get()
+
+
+def start_update_context(user_id: int | None = None):
+    return _current_update.set(UpdateContext(user_id))
+
+
+def finish_update_context(token) -> None:
+    _current_update.reset(token)
+
+
+def count_db_read(count: int = 1) -> None:
+    context = _current_update.get()
+    if context is not None:
+        context.db_reads += count
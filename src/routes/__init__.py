@@ -1,3 +1,4 @@
+from routes import admin
 from routes import avatar
 from routes import conversation_keyboard
 from routes import rating
@@ -0,0 +1,76 @@
+import asyncio
+import datetime
+import logging
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message
+
+from models.app import App
+from utils.analytics import refresh_stats_snapshots
+from utils.voice_stream import reply_latency_ms
+
+logger = logging.getLogger(__name__)
+
+
+async def get_stats(message: Message, bot: AsyncTeleBot):
+    '''
+    Админская статистика из stats_snapshots с временем последнего пересчета
+    '''
+
+    snapshots = await App().Dao.stats.get_all()
+    if not snapshots:
+        await bot.send_message(text='Статистика еще не посчитана, /stats_refresh', chat_id=message.chat.id)
+        return
+
+    now = datetime.datetime.now()
+    lines = []
+    for snapshot in snapshots:
+        age_min = int((now - snapshot["computed_at"]).total_seconds() // 60)
+        lines.append(f'{snapshot["metric"]} ({snapshot["interval"]}, {age_min} мин. назад): {snapshot["value"]}')
+    stats_text = '\n\n'.join(lines)
+
+    # telegram message length limit
+    for i in range(0, len(stats_text), 4096):
+        await bot.send_message(text=stats_text[i:i + 4096], chat_id=message.chat.id)
+
+
+async def get_db_stats(message: Message, bot: AsyncTeleBot):
+    '''
+    Время ответа mongo по командам и коллекциям (с запуска бота), самые затратные сверху,
+    очередь аудио воркеров, кэши и время ответа
+    '''
+
+    stats = App().Managers.db_manager.command_listener.stats()
+    commands = sorted(stats.items(), key=lambda item: item[1]["latency_ms"]["sum"], reverse=True)
+    lines = [f'Чтений из базы на апдейт: {App()["update_context_middleware"].stats()}',
+             f'Аудио (очередь и время обработки): {App().Managers.audio.stats()}',
+             f'Кэш озвучки: {App().Managers.tts_cache.stats()}',
+             f'Кэш пользователей: {App().Dao.user.cache_stats()}',
+             f'Кэш переводов: {App().Dao.translation.cache_stats()}',
+             'Время до первого голосового ответа: ' + ', '.join(
+                 f'{mode} {histogram.snapshot()}' for mode, histogram in reply_latency_ms.items())]
+    for name, command_stats in commands[:20]:
+        latency = command_stats["latency_ms"]
+        reply = command_stats["reply_bytes"]
+        lines.append(f'{name}: {latency["count"]} шт., всего {latency["sum"] / 1000:.1f}с, '
+                     f'p50 {latency["p50"]}мс, p95 {latency["p95"]}мс, max {latency["max"]}мс'
+                     + (f', ответ ~{reply["avg"] / 1024:.1f}КБ' if reply else '')
+                     + (f', ошибок {command_stats["errors"]}' if command_stats["errors"] else ''))
+    await bot.send_message(text='\n'.join(lines)[:4096], chat_id=message.chat.id)
+
+
+# running manual refreshes, the event loop keeps only weak references to tasks
+_refresh_tasks: set[asyncio.Task] = set()
+
+
+def _refresh_done(task: asyncio.Task) -> None:
+    _refresh_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Manual stats refresh failed", exc_info=task.exception())
+
+
+async def refresh_stats(message: Message, bot: AsyncTeleBot):
+    task = asyncio.create_task(refresh_stats_snapshots(App()))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_done)
+    await bot.send_message(text='Пересчет статистики запущен', chat_id=message.chat.id)
@@ -4,11 +4,11 @@ import datetime
 import glob
 import io
 import logging
+import time
 from copy import copy
 
 import numpy as np
 from PIL import Image
-from pydub import AudioSegment
 from telebot import formatting
 from telebot import types
 from telebot.async_telebot import AsyncTeleBot
@@ -17,14 +17,17 @@ from telebot.types import Message, CallbackQuery
 
 from models.app import App
 from routes.english_tips import phrase2start
-from routes.texts import get_start_texts, help_message
+from routes.texts import get_opener_text, get_start_texts, help_message
 from utils.callback_factories import SuggestCallbackData
 from utils.functions import pop_from_dict
-from utils.gpt import voice_chat, text_to_voice_with_duration
+from utils.gpt import voice_chat, voice_chat_stream, send_tts_voice
 from utils.markups import create_conv_reply_markup, create_start_suggests_reply_markup
+from utils.media import send_media
 from utils.message_reactions import set_message_reaction
+from utils.ogg import opus_duration
 from utils.structures import UserData
 from utils.text_utils import is_english, markdown_escaped
+from utils.voice_stream import observe_reply_latency, stream_voice_reply
 
 logger = logging.getLogger(__name__)
 
@@ -37,14 +40,16 @@ async def send_welcome(message: Message, bot: AsyncTeleBot):
     user_id = message.from_user.id
     is_new = False
 
-    if user_id not in App()["known_users"]:
-        await App().Dao.user.create({"user_id": user_id,
+    created = None
+    if not await App().Dao.user.is_known(user_id):
+        # None if the user was created meanwhile (a concurrent /start), it is welcomed as a known user then
+        created = await App().Dao.user.create({"user_id": user_id,
                                      "username": message.from_user.username,
                                      "generations": 0,
                                      "today_generations": 0,
                                      "last_generation_date": datetime.datetime.combine(datetime.datetime.now(),
                                                                                        datetime.time.min),
-                                     "messages": [],
+                                     "messages_count": 0,
                                      "bot_state": "conversation",
                                      "first_message_index": 0,
                                      "temp_data": {},
@@ -52,11 +57,9 @@ async def send_welcome(message: Message, bot: AsyncTeleBot):
                                    
                     
                                      })
-        App()["known_users"].add(user_id)
 
-        path = '/src/assets/welcome_msg_photos/onboarding.gif.mp4'
-        with open(path, 'rb') as video:
-            await bot.send_video(message.chat.id, video)
+    if created is not None:
+        await send_media(bot, message.chat.id, '/src/assets/welcome_msg_photos/onboarding.gif.mp4', 'video')
 
         is_new = True
         name = f', {message.from_user.first_name}' if len(message.from_user.first_name) > 2 else ''
@@ -66,16 +69,13 @@ async def send_welcome(message: Message, bot: AsyncTeleBot):
         user = UserData(**data)
         await App().Dao.user.update({
             "user_id": message.from_user.id,
-            "first_message_index": len(user.messages),
+            "first_message_index": user.messages_count,
             "temp_data": await pop_from_dict(user.temp_data, ['hints', 'transcript_in_ru', 'suggest', 'suggest_id']),
             "bot_state": "conversation"
         })
 
         name = f', {message.from_user.first_name}' if len(message.from_user.first_name) > 2 else ''
 
-    data = await App().Dao.user.find_by_user_id(message.from_user.id)
-    user = UserData(**data)
-
     start_text0, *msg_list = get_start_texts(name, is_new)
 
     time_gap = 0.5
@@ -90,28 +90,27 @@ async def send_welcome(message: Message, bot: AsyncTeleBot):
 
     name = f'{message.from_user.first_name}, ' if len(message.from_user.first_name) > 2 else ''
     question = np.random.choice(phrase2start)
-    response_text = f'{name}Let’s start! 🚀\n\n{question}'
+    opener_text = get_opener_text(question)
+    response_text = f'{name}{opener_text}'
 
     await bot.send_message(text=response_text, chat_id=message.chat.id)
 
 
-    voice_bytesio, voice_duration = await text_to_voice_with_duration(response_text)
     await bot.send_chat_action(chat_id=message.chat.id, action="record_voice")
-
-
-    voice_message = await bot.send_voice(
-        voice=voice_bytesio,
-        chat_id=message.chat.id,
+    voice_message, voice_duration = await send_tts_voice(
+        bot,
+        message.chat.id,
+        opener_text,
         reply_markup=create_conv_reply_markup()
     )
 
+    await App().Dao.user.append_messages(message.from_user.id, [{"role": "assistant",
+                                                                 "content": response_text,
+                                                                 "voice_file_id": voice_message.voice.file_id,
+                                                                 "voice_duration": voice_duration,
+                                                                 "created_at": datetime.datetime.now()}])
     await App().Dao.user.update({
         "user_id": message.from_user.id,
-        "messages": [*user.messages, {"role": "assistant",
-                                      "content": response_text,
-                                      "voice_file_id": voice_message.voice.file_id,
-                                      "voice_duration": voice_duration,
-                                      "created_at": datetime.datetime.now()}],
         "bot_state": "conversation",
         "bot_role": question
     })
@@ -123,6 +122,7 @@ async def send_welcome(message: Message, bot: AsyncTeleBot):
 
 
 async def voice_handler(message: Message, bot: AsyncTeleBot):
+    started_at = time.perf_counter()
     data = await App().Dao.user.find_by_user_id(message.from_user.id)
     user = UserData(**data)
 
@@ -137,11 +137,9 @@ async def voice_handler(message: Message, bot: AsyncTeleBot):
         input_voice_id = message.voice.file_id
         voice = await bot.get_file(input_voice_id)
         downloaded_file = await bot.download_file(voice.file_path)
-        voice_bytesio = io.BytesIO(downloaded_file)
-        voice_bytesio.name = 'voice.mp3'
-        input_msg = voice_bytesio
-        ogg_audio = AudioSegment.from_file(voice_bytesio, format="ogg")
-        input_duration = len(ogg_audio) / 1000
+        # original ogg/opus bytes go to whisper as is, the duration is read from the container without decoding
+        input_msg = ("voice.ogg", downloaded_file, "audio/ogg")
+        input_duration = opus_duration(downloaded_file) or message.voice.duration
     elif message.content_type == "text":
         input_msg = message.text
 
@@ -154,34 +152,62 @@ async def voice_handler(message: Message, bot: AsyncTeleBot):
             emj
         )
 
-    response_text, input_text, tokens_count = await voice_chat(message, input_msg)
-    await bot.send_chat_action(chat_id=message.chat.id, action="record_voice")
-    response_voice_audio, response_duration = await text_to_voice_with_duration(response_text)
-    response_voice_message = await bot.send_voice(
-        voice=response_voice_audio,
-        chat_id=message.chat.id,
-        reply_markup=create_conv_reply_markup()
-    )
+    streaming_config = App()['config'].get('streaming', {})
+    reply = None
+    if streaming_config.get('enabled'):
+        chunks, input_text, tokens_count, input_tokens = await voice_chat_stream(message, input_msg)
+        await bot.send_chat_action(chat_id=message.chat.id, action="record_voice")
+        reply = await stream_voice_reply(bot, message.chat.id, chunks)
+        if not reply.messages:
+            # the streamed answer had no text to voice, asked once more without streaming, the transcript is reused
+            logger.warning(f"Empty streamed answer for user {message.from_user.id}, answering without streaming")
+            input_msg = input_text
+
+    if reply is not None and reply.messages:
+        observe_reply_latency(f"stream-{streaming_config.get('mode', 'chunks')}", started_at, reply.first_sent_at)
+        response_text, response_duration = reply.text, reply.duration
+        response_voice_message = reply.messages[-1]
+        voice_file_ids = [voice_message.voice.file_id for voice_message in reply.messages]
+    else:
+        response_text, input_text, tokens_count, input_tokens = await voice_chat(message, input_msg)
+        if not response_text.strip():
+            logger.warning(f"Empty answer for user {message.from_user.id}, nothing is sent or stored")
+            return None
+        await bot.send_chat_action(chat_id=message.chat.id, action="record_voice")
+        response_voice_message, response_duration = await send_tts_voice(
+            bot,
+            message.chat.id,
+            response_text,
+            reply_markup=create_conv_reply_markup()
+        )
+        observe_reply_latency("full", started_at, time.perf_counter())
+        voice_file_ids = [response_voice_message.voice.file_id]
+
     await bot.send_message(
         chat_id=message.chat.id,
         text=f'🎙 ||{markdown_escaped(response_text)}||',
         # text=markdown_escaped(response_text),
-        parse_mode='MarkdownV2'
+        parse_mode='MarkdownV2',
+        # streamed voices are sent before the answer is complete, the keyboard comes with the transcript
+        **({"reply_markup": create_conv_reply_markup()} if reply is not None and reply.messages else {})
     )
 
+    await App().Dao.user.append_messages(
+        message.from_user.id,
+        [
+            {"role": "user", "content": input_text, "voice_file_id": input_voice_id,
+             "voice_duration": input_duration, "created_at": datetime.datetime.now(),
+             "tokens": tokens_count, "content_tokens": input_tokens},
+            {"role": "assistant", "content": response_text,
+             "voice_file_id": voice_file_ids[0], "voice_duration": response_duration,
+             "created_at": datetime.datetime.now(),
+             # streaming answers sent as several voices
+             **({"voice_file_ids": voice_file_ids} if len(voice_file_ids) > 1 else {})}
+        ]
+    )
     await App().Dao.user.update(
         {
             "user_id": message.from_user.id,
-            "messages": [
-                *user.messages,
-                {"role": "user", "content": input_text, "voice_file_id": input_voice_id,
-                 "voice_duration": input_duration, "created_at": datetime.datetime.now(),
-                 "tokens": tokens_count},
-                {"role": "assistant", "content": response_text,
-                 "voice_file_id": response_voice_message.voice.file_id, "voice_duration": response_duration,
-                 "created_at": datetime.datetime.now()}
-            ]
-            ,
             "temp_data": await pop_from_dict(user.temp_data, ['hints', 'transcript_in_ru', 'suggest', 'suggest_id'])
         }
     )
@@ -91,7 +91,7 @@ async def finish_conv(message: types.Message, bot: AsyncTeleBot):
         reply_markup=types.ReplyKeyboardRemove()
     )
 
-    if len(user.messages[user.first_message_index:]) > 1:  # if dialog is not empty
+    if user.messages_count - user.first_message_index > 1:  # if dialog is not empty
         await bot.send_message(
             text=(await get_feedback(message.from_user.id)),
             chat_id=message.chat.id,
@@ -40,6 +40,6 @@ async def get_rating(message: Message, bot: AsyncTeleBot):
     for i, user in enumerate(users_top):
         rating_text += f"{prefix(i+1)} ***{str(user['name'])[3:]} - {user['talk_time']} мин.\n"
     rating_text += ('--------------------------------------\n'
-                       f'{user_rank}. {message.from_user.username} - {await App().Dao.user.get_talk_time(message.from_user.id, interval="week")} мин.')
+                       f'{user_rank}. {message.from_user.username} - {user_talk_time} мин.')
     rating_text = f'{rating_text}\n'
     await bot.send_message(text=rating_text, chat_id=message.chat.id)
@@ -19,6 +19,11 @@ def get_start_texts(name: str, is_new: bool):
     return start_text0, start_text, start_text1, start_text2, start_text3, start_text4,
 
 
+def get_opener_text(question: str) -> str:
+    # spoken without the user's name, so the voices of all openers are pre-rendered once
+    return f'Let’s start! 🚀\n\n{question}'
+
+
 # send_help
 help_message = (
 
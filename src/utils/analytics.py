@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+from models.app import App
+from utils.stats import distribution_summary, retention_buckets, counts_to_arrays
+
+logger = logging.getLogger(__name__)
+
+INTERVALS = ["day", "week", "month", "30days", "total"]
+
+_refresh_lock = asyncio.Lock()
+
+
+def _str_keys(counts: dict) -> dict:
+    # mongo documents can't have int keys
+    return {str(k): int(v) for k, v in counts.items()}
+
+
+async def _new_users(user_dao, interval):
+    return await user_dao.get_new_users_by_interval(interval)
+
+
+async def _speaking_duration(user_dao, interval):
+    result = await user_dao.get_users_speaking_duration(interval)
+    result.pop("_id", None)
+    return result
+
+
+async def _bottle_days(user_dao, interval):
+    bottle_days = await user_dao.get_general_bottle_days(interval)
+    return {
+        "active_users": _str_keys(bottle_days),
+        **distribution_summary(bottle_days),
+    }
+
+
+async def _funnel_voices(user_dao, interval):
+    cum_result_dict, median_voice, users_sum, percentiles = await user_dao.get_general_funnel_voices(interval)
+    values, cum_weights = counts_to_arrays(cum_result_dict)
+    weights = np.diff(cum_weights, prepend=0)
+    return {
+        "cumulative": _str_keys(cum_result_dict),
+        "median": median_voice,
+        "percentiles": percentiles,
+        "retention": retention_buckets(values, weights),
+        "users": users_sum,
+    }
+
+
+METRICS = {
+    "new_users": _new_users,
+    "speaking_duration": _speaking_duration,
+    "bottle_days": _bottle_days,
+    "funnel_voices": _funnel_voices,
+}
+# get_general_funnel_voices doesn't filter by interval: computed once, stored for every interval
+INTERVAL_INDEPENDENT = {"funnel_voices"}
+
+
+async def refresh_stats_snapshots(app: App) -> None:
+    """
+    Computes every admin metric for every interval and stores the results in stats_snapshots.
+    Concurrent calls wait for the running refresh instead of starting another full scan
+    """
+    if _refresh_lock.locked():
+        async with _refresh_lock:
+            return
+
+    async with _refresh_lock:
+        started = time.monotonic()
+        for metric, compute in METRICS.items():
+            value = None
+            for interval in INTERVALS:
+                if value is None or metric not in INTERVAL_INDEPENDENT:
+                    try:
+                        value = await compute(app.Dao.user, interval)
+                    except Exception as e:
+                        logger.error(f"Failed to compute {metric} ({interval}): {e}", exc_info=True)
+                        continue
+                await app.Dao.stats.save(metric, interval, value)
+        logger.info(f"Stats snapshots refreshed in {time.monotonic() - started:.1f}s")
+
+
+async def stats_snapshot_loop(app: App) -> None:
+    refresh_interval = app["config"].get("analytics", {}).get("refresh_interval", 900)
+    while True:
+        try:
+            # one process refreshes per interval, restarts don't recompute fresh snapshots
+            if await app.Dao.stats.claim_refresh(refresh_interval):
+                await refresh_stats_snapshots(app)
+        except Exception as e:
+            # e.g. mongo unavailable for a moment, the next interval tries again
+            logger.exception(f"Stats snapshots refresh failed: {e}")
+        await asyncio.sleep(refresh_interval)
@@ -0,0 +1,32 @@
+"""
+Audio processing functions executed in the AudioManager process pool.
+They take and return plain bytes, so arguments and results can be pickled
+"""
+import io
+
+from pydub import AudioSegment
+
+
+def decode_duration(data: bytes, audio_format: str) -> float:
+    """decodes the whole file, returns duration in seconds"""
+    return len(AudioSegment.from_file(io.BytesIO(data), format=audio_format)) / 1000
+
+
+def transcode(data: bytes, src_format: str, dst_format: str, codec: str | None = None,
+              bitrate: str | None = None, parameters: list[str] | None = None) -> tuple[bytes, float]:
+    """returns (encoded bytes, duration in seconds)"""
+    audio = AudioSegment.from_file(io.BytesIO(data), format=src_format)
+    output = io.BytesIO()
+    audio.export(output, format=dst_format, codec=codec, bitrate=bitrate, parameters=parameters)
+    return output.getvalue(), len(audio) / 1000
+
+
+def concat(segments: list[bytes], src_format: str, dst_format: str, codec: str | None = None,
+           bitrate: str | None = None, parameters: list[str] | None = None) -> tuple[bytes, float]:
+    """joins the segments into one file, returns (encoded bytes, total duration in seconds)"""
+    audio = AudioSegment.empty()
+    for segment in segments:
+        audio += AudioSegment.from_file(io.BytesIO(segment), format=src_format)
+    output = io.BytesIO()
+    audio.export(output, format=dst_format, codec=codec, bitrate=bitrate, parameters=parameters)
+    return output.getvalue(), len(audio) / 1000
@@ -1,35 +1,57 @@
-import _io
+import asyncio
 import glob
 import io
+import logging
 import os
 import time
 import uuid
 from pathlib import Path
-from typing import List
+from typing import AsyncIterator, List
 
+import httpx
 import requests
-import tiktoken
 import yaml
 from langchain.output_parsers import PydanticOutputParser
-from langchain.schema import HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.pydantic_v1 import BaseModel, Field
-# from langchain_openai import ChatOpenAI
-from langchain_community.chat_models import ChatOpenAI
-# from langchain.chat_models import ChatOpenAI
+from langchain_openai import ChatOpenAI
 from openai import AsyncOpenAI
-from pydub import AudioSegment
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
 from telebot.types import Message
 
 from models.app import App
-from utils.structures import UserData
+from utils.ogg import opus_duration
+from utils.telebot import is_file_id_error
+from utils.tokens import available as tokens_available, count_tokens, count_tokens_cached, message_tokens
 
 config_fname = os.environ.get("APP_CONFIG", "config.yaml")
 OPENAI_API_KEY = ""
 with open(config_fname, encoding='utf-8') as f:
-    OPENAI_API_KEY = yaml.safe_load(f.read())["app"]["openai"]["api_key"]
+    openai_config = yaml.safe_load(f.read())["app"]["openai"]
+    OPENAI_API_KEY = openai_config["api_key"]
 
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+CHAT_MODEL = openai_config.get("chat_model", "gpt-3.5-turbo")
+
+# one connection pool for TTS, whisper and the chat models: connections and TLS sessions are reused between turns
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=openai_config.get("max_connections", 100),
+                        max_keepalive_connections=openai_config.get("max_keepalive_connections", 20)),
+    timeout=httpx.Timeout(openai_config.get("timeout", 60), connect=5),
+)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+logger = logging.getLogger(__name__)
+
+_chat_models: dict[tuple[str, float], ChatOpenAI] = {}
+
+
+def get_chat_model(temperature: float, model: str = CHAT_MODEL) -> ChatOpenAI:
+    """long-lived chat model per (model, temperature), sharing the connection pool of openai_client"""
+    key = (model, temperature)
+    if key not in _chat_models:
+        _chat_models[key] = ChatOpenAI(model=model, temperature=temperature, api_key=OPENAI_API_KEY,
+                                       http_async_client=http_client)
+    return _chat_models[key]
 
 class TopicsResponse(BaseModel):
     topic: str = Field(description="A topic for the conversation suitable for life situations")
@@ -45,6 +67,58 @@ class ConversationSuggests(BaseModel):
     )
 
 
+# prompts are compiled once, user texts are passed as variables
+VOICE_CHAT_SYSTEM = (
+    "You are an assistant for learning English. Your name is Chatodor. "
+    "You live in Telegram. Current time is {current_time} "
+    "You have to help develop the skill of "
+    "speaking English, so you have to maintain a "
+    "dialogue with the student. To noticeably improve speaking and writing skills, "
+    "is needed a week of working with the you for 15 minutes a day! "
+    "Students can check their progress in /rating. "
+    "Always ask a question at the end of the answer! "
+    "Always respond with short messages. "
+    "Topic for the conversation will be the {bot_role}. "
+    "The user has uploaded their file, use the words and constructions "
+    "from it in conversation, you should help the user learn the material in that file. "
+    "Have a conversation about the topic of the file. "
+)
+VOICE_CHAT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", VOICE_CHAT_SYSTEM),
+    MessagesPlaceholder(variable_name="history"),
+    ("human", "{input}"),
+])
+HINTS_PARSER = PydanticOutputParser(pydantic_object=ConversationSuggests)
+HINTS_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", VOICE_CHAT_SYSTEM),
+    MessagesPlaceholder(variable_name="history"),
+    ("human", "{input}\nAnswer in this format: {format_instructions}"),
+]).partial(format_instructions=HINTS_PARSER.get_format_instructions())
+FEEDBACK_PROMPT = ChatPromptTemplate.from_messages([
+    ("system",
+     "You are an assistant for learning English. "
+     "You have to help develop the skill of "
+     "speaking English, so you have to maintain a "
+     "dialogue with the student. Here's my (user) dialogue with you (assistant)"),
+    ("human",
+     "{history}"),
+    ("human",
+     "Please provide a detailed feedback on my grammar and vocabulary. "
+     "Point out as many growth opportunities as possible. "
+     "Reference my messages when providing a feedback.")
+])
+
+TRANSLATION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You're a professional translator from English to Russian"),
+    ("human", "Translate the following English text to Russian: {text}"),
+])
+
+VOICE_CHAT_CHAIN = VOICE_CHAT_PROMPT | get_chat_model(temperature=1)
+HINTS_CHAIN = HINTS_PROMPT | get_chat_model(temperature=1) | HINTS_PARSER
+FEEDBACK_CHAIN = FEEDBACK_PROMPT | get_chat_model(temperature=1)
+TRANSLATION_CHAIN = TRANSLATION_PROMPT | get_chat_model(temperature=0)
+
+
 async def text_to_voice(text: str) -> str:
     ans_path = os.path.join('..', 'answers', f'{str(uuid.uuid4())}.opus')
     speech_file_path = Path(ans_path)
@@ -56,21 +130,104 @@ async def text_to_voice(text: str) -> str:
     return response.content
 
 
-async def text_to_voice_with_duration(text: str):
-    response_mp3 = await openai_client.audio.speech.create(
-        model="tts-1",
-        voice="onyx",
+async def text_to_voice_with_duration(text: str) -> tuple[bytes, float]:
+    """
+    returns (ogg/opus bytes ready for send_voice, duration in seconds).
+    OpenAI returns ogg/opus itself, the answer is re-encoded only for profiles with bitrate/sample_rate
+    """
+    tts_config = App()["config"].get("tts", {})
+    profile = tts_config.get("profiles", {}).get(tts_config.get("profile", "native")) or {}
+
+    audio = io.BytesIO()
+    async with openai_client.audio.speech.with_streaming_response.create(
+        model=tts_config.get("model", "tts-1"),
+        voice=tts_config.get("voice", "onyx"),
         input=text,
-        response_format='mp3'
-    )
-    mp3_bytesio = io.BytesIO(response_mp3.content)
-    mp3_audio = AudioSegment.from_file(mp3_bytesio, format="mp3")
-    duration = len(mp3_audio) / 1000  # продолжительность в секундах
-    opus_audio: _io.BufferedRandom = mp3_audio.export(format="ogg", codec="libopus")
+        response_format="opus",
+    ) as response:
+        async for chunk in response.iter_bytes(chunk_size=16384):
+            audio.write(chunk)
+    opus_audio = audio.getvalue()
+
+    if profile.get("bitrate") or profile.get("sample_rate"):
+        parameters = ["-ar", str(profile["sample_rate"])] if profile.get("sample_rate") else None
+        opus_audio, _ = await App().Managers.audio.transcode(
+            opus_audio, "ogg", "ogg", codec="libopus", bitrate=profile.get("bitrate"), parameters=parameters
+        )
+
+    duration = opus_duration(opus_audio)
+    if duration is None:
+        duration = await App().Managers.audio.duration(opus_audio, "ogg")
     return opus_audio, duration
 
 
-async def get_transcript(audio_file: io.BytesIO) -> str:
+def tts_cache_key(text: str) -> str:
+    tts_config = App()["config"].get("tts", {})
+    return App().Managers.tts_cache.key(text, tts_config.get("voice", "onyx"), tts_config.get("model", "tts-1"),
+                                        f"opus/{tts_config.get('profile', 'native')}")
+
+
+async def warm_up_tts(texts: list[str], concurrency: int = 4) -> int:
+    """
+    synthesizes the texts missing in the TTS cache, at most `concurrency` OpenAI requests at once,
+    and pins them in the cache. Returns the number of synthesized texts
+    """
+    cache = App().Managers.tts_cache
+    keys = {text: tts_cache_key(text) for text in texts if cache.cacheable(text)}
+    missing = [text for text, key in keys.items() if key not in cache]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def synthesize(text: str) -> bool:
+        async with semaphore:
+            try:
+                audio, duration = await text_to_voice_with_duration(text)
+            except Exception as e:
+                logger.warning(f"TTS warmup failed for {text!r}: {e}")
+                return False
+            await cache.put(keys[text], audio, duration, pinned=True)
+            return True
+
+    synthesized = sum(await asyncio.gather(*(synthesize(text) for text in missing)))
+    cache.set_pinned(set(keys.values()))
+    return synthesized
+
+
+async def send_tts_voice(bot: AsyncTeleBot, chat_id: int, text: str, **kwargs) -> tuple[Message, float]:
+    """
+    send_voice with the text spoken by TTS, returns (sent message, duration in seconds).
+    Recurring texts come from the TTS cache: resent by file_id without calling OpenAI and uploading again
+    """
+    cache = App().Managers.tts_cache
+    if not cache.cacheable(text):
+        audio, duration = await text_to_voice_with_duration(text)
+        return await bot.send_voice(chat_id=chat_id, voice=audio, **kwargs), duration
+
+    key = tts_cache_key(text)
+    entry = cache.get(key)
+    if entry is not None and entry["file_id"]:
+        try:
+            return await bot.send_voice(chat_id=chat_id, voice=entry["file_id"], **kwargs), entry["duration"]
+        except ApiTelegramException as e:
+            # file ids belong to the bot, they are lost when the token changes
+            if not is_file_id_error(e):
+                raise
+            logger.warning(f"Cached voice file_id rejected, uploading again: {e}")
+            cache.set_file_id(key, None)
+
+    audio = await cache.read(key) if entry is not None else None
+    if audio is not None:
+        duration = entry["duration"]
+    else:
+        audio, duration = await text_to_voice_with_duration(text)
+        await cache.put(key, audio, duration)
+
+    message = await bot.send_voice(chat_id=chat_id, voice=audio, **kwargs)
+    cache.set_file_id(key, message.voice.file_id)
+    return message, duration
+
+
+async def get_transcript(audio_file: io.BytesIO | tuple[str, bytes, str]) -> str:
+    """audio_file: file object with a name or (file name, bytes, mime type)"""
     transcript = await openai_client.audio.transcriptions.create(
         model="whisper-1",
         file=audio_file,
@@ -80,9 +237,8 @@ async def get_transcript(audio_file: io.BytesIO) -> str:
 
 
 async def get_last_transcript(message: Message) -> str:
-    data = await App().Dao.user.find_by_user_id(message.from_user.id)
-    user = UserData(**data)
-    return user.messages[-1]["content"]
+    last_messages = await App().Dao.user.find_last_messages(message.from_user.id, 1)
+    return last_messages[-1]["content"]
     # Возможно использовать context_messages
     # context_messages = user.messages[user.first_message_index:]
     # if len(context_messages) > 0:
@@ -91,40 +247,23 @@ async def get_last_transcript(message: Message) -> str:
     # return 'Start a dialog first'
 
 
+async def translate_to_ru(text: str) -> str:
+    """translations are shared by all users, a text is sent to the model once"""
+    translation = await App().Dao.translation.get(text)
+    if translation is None:
+        result = await TRANSLATION_CHAIN.ainvoke({"text": text})
+        translation = result.content
+        await App().Dao.translation.save(text, translation)
+    return translation
+
+
 async def get_last_transcript_in_ru(message: Message, model_type: str = 'openai') -> str:
  
-    if model_type == 'openai':
-        model = ChatOpenAI(temperature=0, openai_api_key=OPENAI_API_KEY)
-    else:
+    if model_type != 'openai':
         raise ValueError(f"Unknown model type {model_type}, please choose from ['openai']")
 
     transcript = await get_last_transcript(message)
-    # if transcript == 'Start a dialog first':
-    #     return 'Start a dialog first'
-
-    data = await App().Dao.user.find_by_user_id(message.from_user.id)
-    user = UserData(**data)
-    temp_data = user.temp_data
-
-    if temp_data.get('transcript_in_ru'):
-        return temp_data['transcript_in_ru']
-
-    messages = [
-        SystemMessage(content="You're a professional translator from English to Russian"),
-        HumanMessage(content=f"Translate the following English text to Russian: {transcript}")
-    ]
-
-    result = model(messages)
-
-    temp_data['transcript_in_ru'] = result.content
-    await App().Dao.user.update(
-        {
-            'user_id': message.from_user.id,
-            'temp_data': temp_data
-        }
-    )
-
-    return result.content
+    return await translate_to_ru(transcript)
 
 
 def openai_to_langchain_role(role):
@@ -136,113 +275,83 @@ def openai_to_langchain_role(role):
         return role
 
 
-async def voice_chat(message: Message, audio_or_text: io.BytesIO | str, is_hints: bool = False,
-                     model_type: str = 'openai') -> (str, str):
- 
-    if model_type == 'openai':
-        model = ChatOpenAI(temperature=1, openai_api_key=OPENAI_API_KEY)
-    else:
-        raise ValueError(f"Unknown model type {model_type}, please choose from ['gigachat', 'openai']")
-
+async def _voice_chat_inputs(message: Message, audio_or_text: io.BytesIO | tuple[str, bytes, str] | str
+                            ) -> tuple[dict, str, int | None, int | None]:
+    """
+    returns (prompt variables, user text, tokens count of the prompt, tokens count of the user text),
+    the counts are None without the tiktoken encoding
+    """
     if isinstance(audio_or_text, str):
         text = audio_or_text
     else:
         text = await get_transcript(audio_or_text) or 'empty message'
 
-    data = await App().Dao.user.find_by_user_id(message.from_user.id)
-    user = UserData(**data)
+    user = await App().Dao.user.find_fields(message.from_user.id, ["bot_role", "first_message_index"])
+    bot_role = user.get("bot_role", "english tutor")
 
     # Local time has date and time
     t = time.localtime()
     current_time = time.strftime("%H:%M", t)
 
- 
-    full_text = ""
-    system_text = (
-        "You are an assistant for learning English. Your name is Chatodor. "
-        f"You live in Telegram. Current time is {current_time} "
-        "You have to help develop the skill of "
-        "speaking English, so you have to maintain a "
-        "dialogue with the student. To noticeably improve speaking and writing skills, "
-        "is needed a week of working with the you for 15 minutes a day! "
-        "Students can check their progress in /rating. "
-        "Always ask a question at the end of the answer! "
-        "Always respond with short messages. "
-       
+    # include only last 10 messages
+    context_messages = await App().Dao.message.find_dialog(
+        message.from_user.id, user.get("first_message_index", 0), limit=10
     )
 
+    history = [(openai_to_langchain_role(m["role"]), m["content"]) for m in context_messages]
+    variables = {"history": history, "input": text, "current_time": current_time, "bot_role": bot_role}
+    if not tokens_available():
+        return variables, text, None, None
+
+    # prompt size: the history messages carry their token counts since they were written
+    system_text = VOICE_CHAT_SYSTEM.format(current_time=current_time, bot_role=bot_role)
+    text_tokens = count_tokens(text)
+    tokens_count = (count_tokens_cached(system_text) + sum(message_tokens(msg) for msg in context_messages)
+                    + text_tokens)
+    return variables, text, tokens_count, text_tokens
+
+
+async def voice_chat(message: Message, audio_or_text: io.BytesIO | tuple[str, bytes, str] | str,
+                     is_hints: bool = False, model_type: str = 'openai'
+                     ) -> tuple[str, str, int | None, int | None] | ConversationSuggests:
+    """
+    returns (answer, user text, tokens count of the prompt, tokens count of the user text),
+    the parsed hints with is_hints
+    """
+    if model_type != 'openai':
+        raise ValueError(f"Unknown model type {model_type}, please choose from ['gigachat', 'openai']")
 
-    system_text += f"Topic for the conversation will be the {user.bot_role}."
-
-
-    system_text = (f"{system_text} The user has uploaded their file, use the words and constructions "
-                    f"from it in conversation, you should help the user learn the material in that file. "
-                    f"Have a conversation about the topic of the file. ")
-
-    raw_prompt = [("system", system_text)]
-
-    for _, content in raw_prompt:
-        full_text += content + " "
+    variables, text, tokens_count, text_tokens = await _voice_chat_inputs(message, audio_or_text)
 
-    raw_prompt.append(MessagesPlaceholder(variable_name="history"))
+    if is_hints:
+        return await HINTS_CHAIN.ainvoke(variables)
 
-    context_messages = user.messages[user.first_message_index:]
-    # include only last 10 messages
-    context_messages = context_messages[:10]
+    result = await VOICE_CHAT_CHAIN.ainvoke(variables)
+    return result.content, text, tokens_count, text_tokens
 
-    for msg in context_messages:
-        full_text += msg['content'] + " "
-    full_text += text
 
-    enc = tiktoken.get_encoding("cl100k_base")
-    tokens_count = len(enc.encode(full_text))
+async def voice_chat_stream(message: Message, audio_or_text: io.BytesIO | tuple[str, bytes, str] | str
+                            ) -> tuple[AsyncIterator[str], str, int | None, int | None]:
+    """like voice_chat, but the answer is an async iterator of text chunks as the model generates them"""
+    variables, text, tokens_count, text_tokens = await _voice_chat_inputs(message, audio_or_text)
 
-    history = [(openai_to_langchain_role(m["role"]), m["content"]) for m in context_messages]
+    async def chunks() -> AsyncIterator[str]:
+        async for chunk in VOICE_CHAT_CHAIN.astream(variables):
+            if chunk.content:
+                yield chunk.content
 
-    if is_hints:
-        raw_prompt.append(("human", text + "\nAnswer in this format: {format_instructions}"))
-        prompt = ChatPromptTemplate.from_messages(raw_prompt)
-        parser = PydanticOutputParser(pydantic_object=ConversationSuggests)
-        prompt = prompt.partial(format_instructions=parser.get_format_instructions())
-        chain = prompt | model | parser
-        result = await chain.ainvoke({"history": history})
-        return result
-
-    raw_prompt.append(("human", text))
-    # print('raw_prompt: ', raw_prompt)
-    prompt = ChatPromptTemplate.from_messages(raw_prompt)
-    chain = prompt | model
-    result = await chain.ainvoke({"history": history})
-    return result.content, text, tokens_count
+    return chunks(), text, tokens_count, text_tokens
 
 
 async def get_feedback(user_id, model_type: str = 'openai'):
  
-    if model_type == 'openai':
-        model = ChatOpenAI(temperature=1, openai_api_key=OPENAI_API_KEY)
-    else:
+    if model_type != 'openai':
         raise ValueError(f"Unknown model type {model_type}, please choose from [openai]")
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system",
-         "You are an assistant for learning English. "
-         "You have to help develop the skill of "
-         "speaking English, so you have to maintain a "
-         "dialogue with the student. Here's my (user) dialogue with you (assistant)"),
-        ("human",
-         "{history}"),
-        ("human",
-         "Please provide a detailed feedback on my grammar and vocabulary. "
-         "Point out as many growth opportunities as possible. "
-         "Reference my messages when providing a feedback.")
-    ])
-    data = await App().Dao.user.find_by_user_id(user_id)
-    user = UserData(**data)
-    context_messages = user.messages[user.first_message_index:]
+    user = await App().Dao.user.find_fields(user_id, ["first_message_index"])
     # include only last 10 messages
-    context_messages = context_messages[:10]
+    context_messages = await App().Dao.message.find_dialog(user_id, user.get("first_message_index", 0), limit=10)
 
     history = "\n".join([f"{m['role']}: {m['content']}" for m in context_messages])
-    chain = prompt | model
-    result = await chain.ainvoke({"history": history})
+    result = await FEEDBACK_CHAIN.ainvoke({"history": history})
     return result.content
@@ -0,0 +1,89 @@
+"""
+Sending local media files (videos, photos, animations) by Telegram file_id: uploaded once, reused afterwards
+"""
+import asyncio
+import hashlib
+import logging
+import os
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.types import Message
+
+from models.app import App
+from utils.telebot import is_file_id_error
+
+logger = logging.getLogger(__name__)
+
+# path -> (mtime_ns, size, sha256), the file is hashed again only when it changes
+_hashes: dict[str, tuple[int, int, str]] = {}
+# (sha256, media_type) -> file_id, saves the mongo read on every send
+_file_ids: dict[tuple[str, str], str] = {}
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def file_sha256(path: str) -> tuple[str, int]:
+    """returns (sha256 of the content, size in bytes)"""
+    stat = os.stat(path)
+    cached = _hashes.get(path)
+    if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+        cached = (stat.st_mtime_ns, stat.st_size, await asyncio.to_thread(_sha256, path))
+        _hashes[path] = cached
+    return cached[2], stat.st_size
+
+
+def sent_file_id(message: Message) -> str | None:
+    if message.photo:
+        return message.photo[-1].file_id  # the largest size
+    # telegram may turn a silent mp4 sent with send_video into an animation
+    for attr in ("video", "animation", "document", "audio", "voice", "video_note", "sticker"):
+        media = getattr(message, attr, None)
+        if media is not None:
+            return media.file_id
+    return None
+
+
+async def send_media(bot: AsyncTeleBot, chat_id: int, path: str, media_type: str = "video", **kwargs) -> Message:
+    """
+    bot.send_<media_type>(chat_id, <file>, **kwargs) for a local file.
+    The first send uploads the file and stores the returned file_id in MediaDAO, later sends pass the file_id.
+    A file_id rejected by Telegram (e.g. after the bot token changed) is forgotten and the file is uploaded again,
+    unless another process has stored a new file_id meanwhile
+    """
+    send = getattr(bot, f"send_{media_type}")
+    sha256, size = await file_sha256(path)
+    key = (sha256, media_type)
+
+    file_id = _file_ids.get(key)
+    if file_id is None:
+        file_id = await App().Dao.media.get_file_id(sha256, media_type)
+    rejected = set()
+    while file_id is not None and file_id not in rejected:
+        try:
+            message = await send(chat_id, file_id, **kwargs)
+            _file_ids[key] = file_id
+            return message
+        except ApiTelegramException as e:
+            if not is_file_id_error(e):
+                raise
+            logger.warning(f"Telegram rejected the file_id of {path}: {e}")
+            rejected.add(file_id)
+            _file_ids.pop(key, None)
+            await App().Dao.media.forget(sha256, media_type, file_id)
+            # another process may have uploaded the file again already, its file_id is tried before uploading
+            file_id = await App().Dao.media.get_file_id(sha256, media_type)
+
+    with open(path, "rb") as f:
+        message = await send(chat_id, f, **kwargs)
+    file_id = sent_file_id(message)
+    if file_id is not None:
+        _file_ids[key] = file_id
+        await App().Dao.media.save(sha256, media_type, path, size, file_id)
+    return message
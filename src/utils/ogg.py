@@ -0,0 +1,42 @@
+"""
+Reads the duration of Ogg/Opus files (telegram voice notes, TTS answers) from the container headers, without decoding
+"""
+import struct
+
+OPUS_SAMPLE_RATE = 48000  # granule positions of opus streams are always in 48 kHz samples
+PAGE_HEADER = struct.Struct("<4sBBqIIIB")  # capture pattern, version, type, granule, serial, sequence, crc, segments
+
+
+def _page_at(data: bytes, offset: int) -> tuple[int, int, bytes] | None:
+    """returns (granule position, serial, first packet bytes of the page) or None if there is no valid page"""
+    if offset < 0 or offset + PAGE_HEADER.size > len(data):
+        return None
+    capture, version, _, granule, serial, _, _, segments = PAGE_HEADER.unpack_from(data, offset)
+    if capture != b"OggS" or version != 0:
+        return None
+    body_start = offset + PAGE_HEADER.size + segments
+    body_size = sum(data[offset + PAGE_HEADER.size:body_start])
+    return granule, serial, data[body_start:body_start + body_size]
+
+
+def opus_duration(data: bytes) -> float | None:
+    """
+    (granule position of the last page - pre-skip) / 48000.
+    returns None if data is not a complete Ogg/Opus stream
+    """
+    first_page = _page_at(data, 0)
+    if first_page is None:
+        return None
+    _, serial, head = first_page
+    if head[:8] != b"OpusHead" or len(head) < 12:
+        return None
+    pre_skip = struct.unpack_from("<H", head, 10)[0]
+
+    # the last page of the stream, skipping truncated pages and pages of other streams
+    offset = data.rfind(b"OggS")
+    while offset > 0:
+        page = _page_at(data, offset)
+        if page is not None and page[1] == serial and page[0] >= 0:
+            return max(page[0] - pre_skip, 0) / OPUS_SAMPLE_RATE
+        offset = data.rfind(b"OggS", 0, offset)
+    return None
@@ -0,0 +1,208 @@
+"""
+Synthetic users and conversation history for load tests and benchmarks, see `manage.py seed`
+
+Every user gets the welcome message of the assistant and then voice turns (user voice + assistant answer)
+grouped into sessions. Distributions are heavy-tailed like real usage:
+- voices per user: lognormal, most users send a few voices, a small share sends thousands
+- session length: geometric with a per user Beta distributed stop probability (mixture is heavy-tailed)
+- gaps between sessions: lognormal, from minutes to months
+The same seed and batch size always produce the same data
+"""
+import datetime
+import logging
+import time
+
+import numpy as np
+
+from models.app import App
+
+logger = logging.getLogger(__name__)
+
+# telegram ids are far below this, seeded users never collide with real ones
+DEFAULT_START_USER_ID = 10 ** 12
+
+VOICES_LOGNORMAL = (1.5, 1.4)  # mean, sigma of log(voices per user), median ~4.5
+MAX_VOICES = 5000
+SESSION_STOP_BETA = (1.2, 4.0)  # probability that a voice starts a new session
+MIN_SESSION_STOP = 0.02  # at most ~50 voices per session on average
+SESSION_GAP_LOGNORMAL = (np.log(86400), 1.5)  # seconds, median one day
+TURN_GAP_LOGNORMAL = (np.log(45), 0.6)  # seconds between voices of one session
+ANSWER_DELAY_LOGNORMAL = (np.log(4), 0.4)  # seconds until the assistant answers
+USER_VOICE_LOGNORMAL = (np.log(6), 0.7)  # seconds
+ASSISTANT_VOICE_LOGNORMAL = (np.log(10), 0.5)  # seconds
+RECENCY_DAYS = 30  # mean days since the last activity
+PREMIUM_SHARE = 0.05
+
+PHRASES = {
+    "user": ["Hello!", "I went to the park yesterday.", "Can you repeat that, please?",
+             "My favourite food is pasta.", "I want to practice for my interview.", "What does this word mean?"],
+    "assistant": ["Hi! How are you today?", "That sounds great! What did you do there?",
+                  "Sure! Let me say it more slowly.", "Interesting! Can you tell me more?",
+                  "Good job, your sentence was correct.", "Let's try it once more."],
+}
+
+
+def _lognormal(rng: np.random.Generator, params: tuple[float, float], size: int) -> np.ndarray:
+    return rng.lognormal(params[0], params[1], size)
+
+
+def _group_cumsum(values: np.ndarray, group_starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """cumulative sum restarting at every group, groups are consecutive runs of counts[i] elements"""
+    cumsum = np.cumsum(values)
+    offsets = np.repeat(cumsum[group_starts] - values[group_starts], counts)
+    return cumsum - offsets
+
+
+def generate_batch(rng: np.random.Generator, first_user_id: int, count: int,
+                   now: datetime.datetime) -> tuple[list[dict], list[dict], list[dict]]:
+    """
+    returns (users, messages, talk_time_daily rollups) for user ids [first_user_id, first_user_id + count)
+    """
+    user_ids = np.arange(first_user_id, first_user_id + count, dtype=np.int64)
+    voices = np.minimum(np.floor(_lognormal(rng, VOICES_LOGNORMAL, count)), MAX_VOICES).astype(np.int64)
+    stop_probability = np.maximum(rng.beta(*SESSION_STOP_BETA, count), MIN_SESSION_STOP)
+
+    # voice turns of all users of the batch, user by user
+    total = int(voices.sum())
+    owner = np.repeat(np.arange(count), voices)
+    starts = np.concatenate(([0], np.cumsum(voices)[:-1]))
+    has_voices = voices > 0
+    new_session = rng.random(total) < stop_probability[owner]
+    gaps = np.where(new_session,
+                    _lognormal(rng, SESSION_GAP_LOGNORMAL, total),
+                    _lognormal(rng, TURN_GAP_LOGNORMAL, total))
+    # the first voice follows the welcome message
+    gaps[starts[has_voices]] = _lognormal(rng, TURN_GAP_LOGNORMAL, int(has_voices.sum()))
+    offsets = _group_cumsum(gaps, starts[has_voices], voices[has_voices])
+
+    # the welcome message is sent at signup, the whole history ends RECENCY_DAYS (on average) ago
+    span = np.zeros(count)
+    span[has_voices] = offsets[starts[has_voices] + voices[has_voices] - 1]
+    recency = rng.exponential(RECENCY_DAYS * 86400, count)
+    now64 = np.datetime64(now, "ms")
+    signup = now64 - ((span + recency) * 1000).astype("timedelta64[ms]")
+
+    voice_at = signup[owner] + (offsets * 1000).astype("timedelta64[ms]")
+    answer_at = voice_at + (_lognormal(rng, ANSWER_DELAY_LOGNORMAL, total) * 1000).astype("timedelta64[ms]")
+    voice_duration = np.clip(_lognormal(rng, USER_VOICE_LOGNORMAL, total), 1, 60).round(2)
+    answer_duration = np.clip(_lognormal(rng, ASSISTANT_VOICE_LOGNORMAL, total), 1, 60).round(2)
+    welcome_duration = np.clip(_lognormal(rng, ASSISTANT_VOICE_LOGNORMAL, count), 1, 60).round(2)
+    user_phrases = rng.integers(0, len(PHRASES["user"]), total)
+    answer_phrases = rng.integers(0, len(PHRASES["assistant"]), total + count)
+
+    # position of the voice in the user's history: 0 is the welcome message, then voice, answer, voice, ...
+    position = np.arange(total) - np.repeat(starts, voices)
+    voice_index = 1 + 2 * position
+
+    user_ids_list = user_ids.tolist()
+    signup_list = signup.astype(datetime.datetime).tolist()
+    messages = [{
+        "user_id": user_ids_list[i],
+        "index": 0,
+        "role": "assistant",
+        "content": PHRASES["assistant"][answer_phrases[total + i]],
+        "voice_file_id": None,
+        "voice_duration": float(welcome_duration[i]),
+        "created_at": signup_list[i],
+    } for i in range(count)]
+
+    owner_ids = user_ids[owner].tolist()
+    voice_index_list = voice_index.tolist()
+    voice_at_list = voice_at.astype(datetime.datetime).tolist()
+    answer_at_list = answer_at.astype(datetime.datetime).tolist()
+    voice_duration_list = voice_duration.tolist()
+    answer_duration_list = answer_duration.tolist()
+    for i in range(total):
+        messages.append({
+            "user_id": owner_ids[i],
+            "index": voice_index_list[i],
+            "role": "user",
+            "content": PHRASES["user"][user_phrases[i]],
+            "voice_file_id": f"seed-{owner_ids[i]}-{voice_index_list[i]}",
+            "voice_duration": voice_duration_list[i],
+            "created_at": voice_at_list[i],
+        })
+        messages.append({
+            "user_id": owner_ids[i],
+            "index": voice_index_list[i] + 1,
+            "role": "assistant",
+            "content": PHRASES["assistant"][answer_phrases[i]],
+            "voice_file_id": None,
+            "voice_duration": answer_duration_list[i],
+            "created_at": answer_at_list[i],
+        })
+
+    premium = rng.random(count) < PREMIUM_SHARE
+    last_active = np.where(has_voices, now64 - (recency * 1000).astype("timedelta64[ms]"), signup)
+    last_active_list = last_active.astype("datetime64[D]").astype(datetime.datetime).tolist()
+    users = [{
+        "user_id": user_ids_list[i],
+        "username": f"seed_user_{user_ids_list[i]}",
+        "subscription": "premium" if premium[i] else "free",
+        "subscription_start_date": signup_list[i],
+        "generations": int(voices[i]),
+        "today_generations": 0,
+        "last_generation_date": datetime.datetime.combine(last_active_list[i], datetime.time.min),
+        "messages_count": int(1 + 2 * voices[i]),
+        "bot_state": "conversation",
+        "first_message_index": 0,
+        "temp_data": {},
+        "email": None,
+        "payments_data": {"payment_id": None},
+        "preferences": {"sub_autoextend": bool(premium[i])},
+    } for i in range(count)]
+
+    return users, messages, build_rollups(messages)
+
+
+def build_rollups(messages: list[dict]) -> list[dict]:
+    """talk_time_daily documents of the messages, same as TalkTimeRollupDAO.add_messages would produce"""
+    rollups = {}
+    for msg in messages:
+        day = datetime.datetime.combine(msg["created_at"].date(), datetime.time.min)
+        rollup = rollups.get((msg["user_id"], day))
+        if rollup is None:
+            rollup = rollups[(msg["user_id"], day)] = {
+                "user_id": msg["user_id"],
+                "date": day,
+                "talk_time": {"user": 0, "assistant": 0},
+                "messages": {"user": 0, "assistant": 0},
+                "tokens": 0,
+            }
+        rollup["talk_time"][msg["role"]] += msg["voice_duration"]
+        rollup["messages"][msg["role"]] += 1
+    return list(rollups.values())
+
+
+async def seed_users(app: App, count: int, seed: int = 0, start_user_id: int = DEFAULT_START_USER_ID,
+                     batch_size: int = 10000, now: datetime.datetime | None = None) -> dict:
+    """
+    Inserts <count> synthetic users with ids from start_user_id, their messages and rollups.
+    returns {"users": n, "messages": n, "rollups": n}
+    """
+    now = now or datetime.datetime.now()
+    totals = {"users": 0, "messages": 0, "rollups": 0}
+    started = time.monotonic()
+    for batch_number, first in enumerate(range(0, count, batch_size)):
+        # independent stream per batch, so a batch doesn't depend on the random draws of the previous ones
+        rng = np.random.default_rng([seed, batch_number])
+        users, messages, rollups = generate_batch(rng, start_user_id + first, min(batch_size, count - first), now)
+
+        await app.Dao.user.insert_many(users)
+        await app.Dao.message.insert_many(messages)
+        await app.Dao.talk_time.insert_many(rollups)
+
+        totals["users"] += len(users)
+        totals["messages"] += len(messages)
+        totals["rollups"] += len(rollups)
+        logger.info(f"Seeded {totals['users']}/{count} users, {totals['messages']} messages "
+                    f"({time.monotonic() - started:.0f}s)")
+    return totals
+
+
+async def drop_seeded_users(app: App, start_user_id: int = DEFAULT_START_USER_ID) -> None:
+    """deletes users with ids >= start_user_id with their messages and rollups"""
+    query = {"user_id": {"$gte": start_user_id}}
+    for dao in (app.Dao.user, app.Dao.message, app.Dao.talk_time):
+        result = await dao.db[dao.COLLECTION_NAME].delete_many(query)
+        logger.info(f"Deleted {result.deleted_count} documents from {dao.COLLECTION_NAME}")
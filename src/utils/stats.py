@@ -0,0 +1,61 @@
+import numpy as np
+
+DEFAULT_PERCENTILES = (50, 75, 90, 99)
+DEFAULT_RETENTION_THRESHOLDS = (1, 2, 3, 5, 7, 14, 30)
+
+
+def counts_to_arrays(counts: dict) -> tuple[np.ndarray, np.ndarray]:
+    """{value: number of users} -> (sorted values, weights)"""
+    if not counts:
+        return np.array([], dtype=float), np.array([], dtype=np.int64)
+    values = np.fromiter(counts.keys(), dtype=float, count=len(counts))
+    weights = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    order = np.argsort(values)
+    return values[order], weights[order]
+
+
+def weighted_percentiles(values: np.ndarray, weights: np.ndarray, percentiles=DEFAULT_PERCENTILES) -> dict:
+    """
+    Same result as np.percentile(np.repeat(values, weights), percentiles) (linear interpolation),
+    without materializing one element per user. values must be sorted
+    """
+    total = int(weights.sum())
+    if total == 0:
+        return {f"p{p}": float("nan") for p in percentiles}
+
+    cum_weights = np.cumsum(weights)
+    positions = (total - 1) * np.asarray(percentiles, dtype=float) / 100
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    # value of the k-th element of the repeated array is values[searchsorted(cum_weights, k, 'right')]
+    lower_values = values[np.searchsorted(cum_weights, lower, side="right")]
+    upper_values = values[np.searchsorted(cum_weights, upper, side="right")]
+    result = lower_values + (positions - lower) * (upper_values - lower_values)
+    return {f"p{p}": float(v) for p, v in zip(percentiles, result)}
+
+
+def cumulative_counts(values: np.ndarray, weights: np.ndarray) -> dict:
+    """{value: number of users with value <= it}"""
+    return {int(v): int(c) for v, c in zip(values, np.cumsum(weights))}
+
+
+def retention_buckets(values: np.ndarray, weights: np.ndarray, thresholds=DEFAULT_RETENTION_THRESHOLDS) -> dict:
+    """{">=N": number of users with value >= N}"""
+    # users at or above the threshold = total - users below it
+    cum_weights = np.concatenate(([0], np.cumsum(weights)))
+    below = cum_weights[np.searchsorted(values, np.asarray(thresholds, dtype=float), side="left")]
+    return {f">={t}": int(cum_weights[-1] - b) for t, b in zip(thresholds, below)}
+
+
+def distribution_summary(counts: dict, exclude_zero: bool = True) -> dict:
+    """
+    counts: {value: number of users}, e.g. {voices sent: users} or {active days: users}
+    returns percentiles (zero values excluded if exclude_zero), retention buckets and the number of users
+    """
+    values, weights = counts_to_arrays(counts)
+    nonzero = values != 0 if exclude_zero else np.ones(len(values), dtype=bool)
+    return {
+        "users": int(weights.sum()),
+        "percentiles": weighted_percentiles(values[nonzero], weights[nonzero]),
+        "retention": retention_buckets(values, weights),
+    }
@@ -11,7 +11,8 @@ class UserData:
     generations: int = 0
     today_generations: int = 0
     last_generation_date: datetime.datetime | None = None
-    messages: list = field(default_factory=lambda: [])
+    messages: list = field(default_factory=lambda: [])  # legacy, history lives in the messages collection
+    messages_count: int = 0
     bot_state: str = field(default_factory=lambda: "default")
     first_message_index: int = 0
     temp_data: dict = field(default_factory=lambda: {})
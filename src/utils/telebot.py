@@ -1,6 +1,8 @@
 import uuid
 import typing
 
+from telebot.asyncio_helper import ApiTelegramException
+
 
 class UnlimitedCallbackData:
     """
@@ -88,4 +90,12 @@ class UnlimitedCallbackData:
         del self._cache[id]
 
         # result.update(zip(self._part_names, parts))
-        return result
\ No newline at end of file
+        return result
+
+
+def is_file_id_error(e: ApiTelegramException) -> bool:
+    """
+    Telegram rejected the file_id itself ("wrong file identifier", "wrong remote file identifier",
+    "file reference expired"), not the chat: blocked bots, rate limits and missing chats are not file errors
+    """
+    return e.error_code == 400 and "file" in (e.description or "").lower()
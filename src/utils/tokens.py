@@ -0,0 +1,77 @@
+"""
+Token counting with the cl100k_base encoding of tiktoken.
+The BPE file is read from assets/tiktoken (tiktoken cache layout) and never downloaded at runtime.
+It is not in the repo yet: `python3 manage.py tiktoken` downloads it there on a host with network,
+commit it, the docker build fails without it.
+Without the file counts are estimated by length and not stored with the messages
+"""
+import functools
+import hashlib
+import logging
+import os
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+ENCODING_NAME = "cl100k_base"
+CHARS_PER_TOKEN = 4  # estimate for English text when the encoding is not available
+# tiktoken caches a BPE file under the sha1 of its url
+BPE_URL = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+BPE_FILE = hashlib.sha1(BPE_URL.encode()).hexdigest()
+TIKTOKEN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets", "tiktoken")
+
+# tiktoken reads TIKTOKEN_CACHE_DIR when an encoding is loaded, a directory set by the deployment wins
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_DIR)
+
+
+def bpe_path() -> str:
+    return os.path.join(os.environ["TIKTOKEN_CACHE_DIR"], BPE_FILE)
+
+
+@functools.cache
+def get_encoding() -> tiktoken.Encoding | None:
+    """None if the BPE file is not in TIKTOKEN_CACHE_DIR, checked once per process without network"""
+    if not os.path.exists(bpe_path()):
+        logger.warning(f"tiktoken {ENCODING_NAME} is not in {os.environ['TIKTOKEN_CACHE_DIR']} "
+                       f"(python3 manage.py tiktoken), token counts are estimated")
+        return None
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def download() -> str:
+    """downloads the BPE file into TIKTOKEN_CACHE_DIR, returns its path"""
+    tiktoken.get_encoding(ENCODING_NAME)
+    return bpe_path()
+
+
+def available() -> bool:
+    return get_encoding() is not None
+
+
+def preload() -> bool:
+    """loads the encoding at startup instead of on the first message, returns whether it is available"""
+    if not available():
+        return False
+    logger.info(f"tiktoken {ENCODING_NAME} loaded from {os.environ['TIKTOKEN_CACHE_DIR']}")
+    return True
+
+
+def count_tokens(text: str) -> int:
+    """exact with the encoding, estimated by length without it (see available())"""
+    encoding = get_encoding()
+    if encoding is None:
+        return -(-len(text or "") // CHARS_PER_TOKEN)
+    return len(encoding.encode(text or "", disallowed_special=()))
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens_cached(text: str) -> int:
+    """for texts repeated between turns: system prompts, openers"""
+    return count_tokens(text)
+
+
+def message_tokens(message: dict) -> int:
+    """the count stored on write, counted for messages written before it was stored"""
+    content_tokens = message.get("content_tokens")
+    return count_tokens(message.get("content") or "") if content_tokens is None else content_tokens
@@ -0,0 +1,123 @@
+"""
+Streaming answers: the model output is cut into sentences while it is generated and the sentences are synthesized
+concurrently, so the first voice doesn't wait for the whole completion and the whole TTS
+"""
+import asyncio
+import re
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message
+
+from models.app import App
+from utils.gpt import text_to_voice_with_duration
+from utils.metrics import Histogram
+
+# whitespace after the end of a sentence, "3.5" or "e.g.," are not cut
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…])["”’)]*\s+')
+
+# time from the user message to the first voice of the answer, per answer mode
+reply_latency_ms: dict[str, Histogram] = {}
+
+
+@dataclass
+class VoiceReply:
+    text: str
+    duration: float
+    messages: list[Message] = field(default_factory=list)
+    first_sent_at: float | None = None  # time.perf_counter() when the first voice was sent
+
+
+def observe_reply_latency(mode: str, started_at: float, sent_at: float) -> None:
+    reply_latency_ms.setdefault(mode, Histogram()).observe((sent_at - started_at) * 1000)
+
+
+def pop_sentences(buffer: str, min_chars: int) -> tuple[list[str], str]:
+    """
+    complete sentences from the start of the buffer and the incomplete rest.
+    Short sentences are joined with the next ones up to min_chars, one TTS request per few words costs more
+    """
+    parts = SENTENCE_BOUNDARY.split(buffer)
+    rest = parts.pop()
+    sentences, current = [], ""
+    for part in parts:
+        current = f"{current} {part}" if current else part
+        if len(current) >= min_chars:
+            sentences.append(current)
+            current = ""
+    if current:
+        rest = f"{current} {rest}"
+    return sentences, rest
+
+
+async def stream_voice_reply(bot: AsyncTeleBot, chat_id: int, chunks: AsyncIterator[str], **kwargs) -> VoiceReply:
+    """
+    streaming.mode "chunks": every sentence is sent as its own voice as soon as it and the previous ones are ready.
+    streaming.mode "stitch": one voice, the synthesized sentences are joined by the audio workers.
+    kwargs are passed to every send_voice, a keyboard for the whole answer goes with the caller's next message:
+    which voice is the last one is known only when the model finishes.
+    An answer without text is not sent, the reply has no messages then
+    """
+    streaming_config = App()["config"].get("streaming", {})
+    mode = streaming_config.get("mode", "chunks")
+    min_chars = streaming_config.get("min_sentence_chars", 30)
+    semaphore = asyncio.Semaphore(streaming_config.get("tts_concurrency", 3))
+
+    async def synthesize(sentence: str) -> tuple[bytes, float]:
+        async with semaphore:
+            return await text_to_voice_with_duration(sentence)
+
+    reply = VoiceReply(text="", duration=0)
+    # synthesized sentences in answer order, None when the answer is complete
+    queue: asyncio.Queue[asyncio.Task | None] = asyncio.Queue()
+    tasks: list[asyncio.Task] = []
+
+    def submit(sentence: str) -> None:
+        if sentence.strip():
+            task = asyncio.create_task(synthesize(sentence.strip()))
+            tasks.append(task)
+            queue.put_nowait(task)
+
+    async def send_chunks() -> None:
+        while (task := await queue.get()) is not None:
+            audio, duration = await task
+            reply.messages.append(await bot.send_voice(chat_id=chat_id, voice=audio, **kwargs))
+            reply.duration += duration
+            if reply.first_sent_at is None:
+                reply.first_sent_at = time.perf_counter()
+
+    sender = asyncio.create_task(send_chunks()) if mode == "chunks" else None
+    try:
+        buffer = ""
+        async for chunk in chunks:
+            reply.text += chunk
+            buffer += chunk
+            sentences, buffer = pop_sentences(buffer, min_chars)
+            for sentence in sentences:
+                submit(sentence)
+        submit(buffer)
+        queue.put_nowait(None)
+
+        if sender is not None:
+            await sender
+        elif tasks:
+            segments = await asyncio.gather(*tasks)
+            audio, reply.duration = await stitch([audio for audio, _ in segments])
+            reply.messages.append(await bot.send_voice(chat_id=chat_id, voice=audio, **kwargs))
+            reply.first_sent_at = time.perf_counter()
+    finally:
+        for task in [*tasks, sender]:
+            if task is not None and not task.done():
+                task.cancel()
+    return reply
+
+
+async def stitch(segments: list[bytes]) -> tuple[bytes, float]:
+    """one ogg/opus file of the segments and its exact duration"""
+    tts_config = App()["config"].get("tts", {})
+    profile = tts_config.get("profiles", {}).get(tts_config.get("profile", "native")) or {}
+    parameters = ["-ar", str(profile["sample_rate"])] if profile.get("sample_rate") else None
+    return await App().Managers.audio.concat(segments, "ogg", "ogg", codec="libopus",
+                                             bitrate=profile.get("bitrate"), parameters=parameters)